@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+import fcntl
+import os
+import ptty
+import ptyreader
+import trollius
+import writequeue
+
+
+class AsyncSession(ptyreader.PtyReader):
+    """
+    A command running in a pty, driven by a trollius event loop instead of
+    Qt. The loop watches the pty with add_reader and add_writer, and the
+    exit of the child through the child watcher of its policy, which has
+    to be attached to loop (it is for the default loop of the main thread).
+
+    Like the rest of haikuterm this is Python 2 only, hence trollius, the
+    asyncio port for it. read_chunks returns a future and exited is one,
+    they're waited for with "yield From(...)" in a trollius coroutine.
+
+    Given a V102Terminal the output is parsed into it as it's read, and
+    resize() resizes it too; read_chunks is then left with nothing to
+    return.
+    """
+    def __init__(self, cmd_path, loop=None, encoding="utf-8",
+                 errors="replace", max_chunks=64, terminal=None):
+        self.loop = loop or trollius.get_event_loop()
+        self.terminal = terminal
+
+        self.cmd_path = cmd_path
+        self.stream = ptty.spawn(cmd_path)
+        self.fd = self.stream.fileno()
+        fl = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+        self.init_reader(self.fd, encoding, errors)
+
+        # decoded output not taken by read_chunks yet, reading pauses while
+        # there are max_chunks of them so the child waits for us
+        self.chunks = []
+        self.max_chunks = max_chunks
+        self.waiter = None
+        self.reading = False
+        self.eof = False
+
+        # input the pty didn't take yet
+        self.write_queue = writequeue.WriteQueue(self.fd, encoding)
+        self.writing = False
+
+        # the exit status of the child, minus the signal that killed it
+        self.exited = trollius.Future(loop=self.loop)
+
+        self._resume_reading()
+        trollius.get_child_watcher().add_child_handler(self.stream.pid,
+                                                       self._child_exited)
+
+    def read_chunks(self):
+        """
+        Returns a future with the list of the chunks of output decoded since
+        the last call, done as soon as there's one. Its list is empty once
+        the pty was closed.
+        """
+        future = trollius.Future(loop=self.loop)
+        if self.chunks or self.eof:
+            future.set_result(self._take_chunks())
+        else:
+            self.waiter = future
+        return future
+
+    def write(self, text):
+        """
+        Sends text to the child, encoding it if it's unicode. What the pty
+        doesn't take right away is written once it's writable again.
+        """
+        self.write_queue.put(text)
+        self._update_writer()
+
+    def paste(self, text, bracketed=False):
+        """
+        Sends pasted text to the child, see WriteQueue.paste.
+        """
+        self.write_queue.paste(text, bracketed)
+        self._update_writer()
+
+    def resize(self, rows, cols):
+        if self.terminal is not None:
+            self.terminal.Resize(rows, cols)
+        self.stream.setwinsize(rows, cols)
+
+    def close(self):
+        """
+        Stops watching the pty and terminates the child if it's running.
+        """
+        self._pause_reading()
+        self._stop_writing()
+        trollius.get_child_watcher().remove_child_handler(self.stream.pid)
+        if not self.exited.done():
+            self.stream.terminate(True)
+            self._set_exit_status()
+
+    def _take_chunks(self):
+        chunks, self.chunks = self.chunks, []
+        if not self.eof:
+            self._resume_reading()
+        return chunks
+
+    def _wake_reader(self):
+        if self.waiter is not None:
+            if not self.waiter.done():
+                self.waiter.set_result(self._take_chunks())
+            self.waiter = None
+
+    def _resume_reading(self):
+        if not self.reading:
+            self.loop.add_reader(self.fd, self._read_ready)
+            self.reading = True
+
+    def _pause_reading(self):
+        if self.reading:
+            self.loop.remove_reader(self.fd)
+            self.reading = False
+
+    def _read(self):
+        data, count, broken_pipe = self.drain(self.read_budget)
+        output = self.decode_input(data)
+        if output:
+            if self.terminal is not None:
+                self.terminal.ProcessInput(output)
+            else:
+                self.chunks.append(output)
+        if broken_pipe:
+            self._pause_reading()
+            self.eof = True
+        return count
+
+    def _read_ready(self):
+        self.wakeups += 1
+        self._read()
+        if len(self.chunks) >= self.max_chunks:
+            self._pause_reading()
+        if self.chunks or self.eof:
+            self._wake_reader()
+
+    def _write_ready(self):
+        self.write_queue.flush()
+        self._update_writer()
+
+    def _update_writer(self):
+        if not self.write_queue.wants_write():
+            self._stop_writing()
+        elif not self.writing:
+            self.loop.add_writer(self.fd, self._write_ready)
+            self.writing = True
+
+    def _stop_writing(self):
+        if self.writing:
+            self.loop.remove_writer(self.fd)
+            self.writing = False
+
+    def _child_exited(self, pid, returncode):
+        # the watcher reaped the child, tell the spawn object
+        self.stream.terminated = True
+        if returncode < 0:
+            self.stream.exitstatus = None
+            self.stream.signalstatus = -returncode
+        else:
+            self.stream.exitstatus = returncode
+            self.stream.signalstatus = None
+
+        # what the child wrote right before exiting is still in the pty
+        while not self.eof and self._read() == self.read_budget:
+            pass
+        self._pause_reading()
+        self._stop_writing()
+        self.write_queue.clear()
+        self.eof = True
+        self._wake_reader()
+        self._set_exit_status()
+
+    def _set_exit_status(self):
+        if self.exited.done():
+            return
+        if self.stream.signalstatus is not None:
+            self.exited.set_result(-self.stream.signalstatus)
+        else:
+            self.exited.set_result(self.stream.exitstatus)
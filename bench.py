@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Headless paint benchmark for HaikutermWidget.
+
+Feeds recorded or generated output streams to a widget that is never shown
+on screen, forcing a frame and a paint into a QImage after every chunk, and
+prints one JSON object per scenario with the paint cost per frame, the cells
+drawn per frame and the resulting frames per second:
+
+    python bench.py [--scenario NAME]... [--stream FILE] [--frames N]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+# must be set before QApplication is created, platforms without QPA fall
+# back to the raster graphics system below
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt4 import QtGui, QtCore
+import widget
+
+COLS = 80
+ROWS = 24
+
+
+def full_screen_color(frames):
+    """
+    Repaints the whole screen every frame, every line in a different color.
+    """
+    for frame in xrange(frames):
+        chunk = [u"\033[H"]
+        for row in xrange(ROWS):
+            color = 31 + (frame + row) % 7
+            chunk.append(u"\033[%d;1m" % color)
+            chunk.append((u"%02d" % row) * (COLS / 2))
+            if row < ROWS - 1:
+                chunk.append(u"\r\n")
+        chunk.append(u"\033[0m")
+        yield u"".join(chunk)
+
+
+def scrolling_flood(frames, lines_per_frame=50):
+    """
+    Scrolls the screen lines_per_frame lines every frame, like a build log.
+    """
+    line = 0
+    for frame in xrange(frames):
+        chunk = []
+        for i in xrange(lines_per_frame):
+            chunk.append(u"[%6d] compiling module_%d.c\r\n" % (line, line))
+            line += 1
+        yield u"".join(chunk)
+
+
+def prompt_typing(frames):
+    """
+    Echoes one typed character per frame after a prompt.
+    """
+    yield u"user@host:~$ "
+    text = u"ls -la /usr/share/doc | less "
+    for frame in xrange(frames - 1):
+        yield text[frame % len(text)]
+
+
+def recorded(path, chunk_size=16384):
+    """
+    Replays a recorded stream of child output in chunk_size pieces.
+    """
+    stream = open(path, "rb")
+    try:
+        while True:
+            data = stream.read(chunk_size)
+            if not data:
+                break
+            yield data.decode("utf-8", "replace")
+    finally:
+        stream.close()
+
+
+SCENARIOS = {
+    "full_screen_color": full_screen_color,
+    "scrolling_flood": scrolling_flood,
+    "prompt_typing": prompt_typing,
+}
+
+
+def run_scenario(w, name, chunks):
+    image = QtGui.QImage(w.size(), QtGui.QImage.Format_RGB32)
+    flags = QtGui.QWidget.RenderFlags(QtGui.QWidget.DrawWindowBackground)
+
+    w.terminal.ProcessInput(u"\033[2J\033[H")
+    w.redraw()
+
+    parse_times = []
+    paint_times = []
+    cells = []
+    for chunk in chunks:
+        start = time.time()
+        w.terminal.ProcessInput(chunk)
+        parsed = time.time()
+
+        cells_drawn = w.rasterizer.cells_drawn
+        w.render_frame()
+        w.render(image, QtCore.QPoint(), QtGui.QRegion(), flags)
+        painted = time.time()
+
+        parse_times.append((parsed - start) * 1000)
+        paint_times.append((painted - parsed) * 1000)
+        cells.append(w.rasterizer.cells_drawn - cells_drawn)
+
+    frames = len(paint_times)
+    total = sum(parse_times) + sum(paint_times)
+    paint_sorted = sorted(paint_times)
+    return {
+        "scenario": name,
+        "frames": frames,
+        "parse_ms_per_frame": sum(parse_times) / max(frames, 1),
+        "paint_ms_per_frame": sum(paint_times) / max(frames, 1),
+        "paint_ms_p95": paint_sorted[int(frames * 0.95)] if frames else 0,
+        "cells_per_frame": float(sum(cells)) / max(frames, 1),
+        "fps": frames / (total / 1000) if total else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenario", action="append",
+                        choices=sorted(SCENARIOS),
+                        help="scenario to run, all of them by default")
+    parser.add_argument("--stream", action="append", default=[],
+                        help="recorded child output to replay")
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--output", help="append the results to this file")
+    args = parser.parse_args()
+
+    app = QtGui.QApplication([sys.argv[0], "-graphicssystem", "raster"])
+
+    w = widget.HaikutermWidget(app=app)
+    w.setAttribute(QtCore.Qt.WA_DontShowOnScreen)
+    w.fixed_size = 1
+    w.resize(COLS * 10 + w.scroll_bar.sizeHint().width(), ROWS * 18)
+    w.show()
+    app.processEvents()
+
+    results = []
+    for name in args.scenario or sorted(SCENARIOS):
+        results.append(run_scenario(w, name, SCENARIOS[name](args.frames)))
+    for path in args.stream:
+        results.append(run_scenario(w, os.path.basename(path),
+                                    recorded(path)))
+
+    output = sys.stdout
+    if args.output:
+        output = open(args.output, "a")
+    for result in results:
+        output.write(json.dumps(result, sort_keys=True) + "\n")
+    if args.output:
+        output.close()
+
+    w.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,681 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Session daemon. It owns the children and their terminal state behind a
+Unix socket, so terminals survive the GUI and can be attached again:
+
+    python daemon.py SOCKET_PATH
+
+or, to watch a session read only from a terminal:
+
+    python daemon.py SOCKET_PATH --watch NAME
+
+Messages in both directions are JSON objects, each preceded by its length
+as a 4 byte big endian integer. Clients send:
+
+    {"op": "attach", "name": ..., "cmd": ..., "rows": ..., "cols": ...}
+    {"op": "input", "data": ...}
+    {"op": "paste", "data": ..., "bracketed": ...}
+    {"op": "resize", "rows": ..., "cols": ...}
+    {"op": "detach"}
+    {"op": "kill"}
+    {"op": "list"}
+    {"op": "watch", "name": ...}
+
+On attach the daemon sends a "snapshot" of the screen and then "damage"
+messages with what changed since the previous message. Both carry the
+cursor, the lines ([row, first_col, text, runs], runs being [attr_id,
+count] pairs) and the renditions ([attr_id, Rendition.key()] pairs) not
+sent before; damage also carries the no. of lines scrolled and, as
+"history", the lines that scrolled off the top, at most a screenful or the
+history size of the session. More scrolled lines than that are gone, the
+whole screen is in the damage then. The snapshot is built from the screen
+only, never by replaying output, so attaching costs the same however much
+the child wrote. "exit" tells the session
+ended, "sessions" answers "list".
+
+A watcher gets "vt" messages instead, with the escape sequences turning
+the screen it was last sent into the current one (see reencode). A watcher
+that hasn't read its last frame yet skips frames until it has.
+"""
+import collections
+from errno import EAGAIN, EINTR
+import fcntl
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import emuvt100
+import ptty
+import ptyreader
+import reencode
+import writequeue
+
+HEADER = struct.Struct("!I")
+
+
+def encode_message(message):
+    data = json.dumps(message, separators=(",", ":"))
+    return HEADER.pack(len(data)) + data
+
+
+class MessageBuffer(object):
+    """
+    Splits a stream of bytes into messages.
+    """
+    def __init__(self):
+        self.data = ""
+
+    def feed(self, data):
+        """
+        Adds data and returns the messages completed by it.
+        """
+        self.data += data
+        messages = []
+        start = 0
+        while len(self.data) - start >= HEADER.size:
+            size, = HEADER.unpack_from(self.data, start)
+            end = start + HEADER.size + size
+            if len(self.data) < end:
+                break
+            messages.append(json.loads(self.data[start + HEADER.size:end]))
+            start = end
+        self.data = self.data[start:]
+        return messages
+
+
+def encode_cells(chars, renditions):
+    """
+    Returns the text of the cells and their attribute ids, run length
+    encoded.
+    """
+    runs = []
+    for rendition in renditions:
+        attr_id = rendition.attr_id if rendition is not None else 0
+        if runs and runs[-1][0] == attr_id:
+            runs[-1][1] += 1
+        else:
+            runs.append([attr_id, 1])
+    return u"".join(chars), runs
+
+
+def set_non_blocking(fd):
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+
+class Connection(object):
+    """
+    A client of the daemon.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.buffer = MessageBuffer()
+        self.output = ""
+        self.session = None
+        # set for watchers, stale when frames were skipped
+        self.encoder = None
+        self.stale = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, message):
+        self.output += encode_message(message)
+
+    def receive(self):
+        """
+        Returns the messages received, or None once the client is gone.
+        """
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, err:
+            if err.errno in (EAGAIN, EINTR):
+                return []
+            return None
+        if not data:
+            return None
+        return self.buffer.feed(data)
+
+    def flush(self):
+        try:
+            sent = self.sock.send(self.output)
+        except socket.error, err:
+            if err.errno in (EAGAIN, EINTR):
+                return True
+            return False
+        self.output = self.output[sent:]
+        return True
+
+
+class DaemonSession(ptyreader.PtyReader):
+    """
+    A child in a pty and the terminal its output is parsed into, shared by
+    the clients attached to it.
+    """
+    def __init__(self, name, cmd_path, rows, cols, history_size=100):
+        self.name = name
+        self.terminal = emuvt100.V102Terminal(rows, cols)
+        self.terminal.SetHistorySize(history_size)
+        self.history_size = history_size
+        self.terminal.SetCallback(self.terminal.CALLBACK_SCROLL_UP_SCREEN,
+                                  self._scroll_up)
+        self.terminal.SetCallback(
+            self.terminal.CALLBACK_UPDATE_WINDOW_TITLE, self._set_title)
+        # nobody is looking yet
+        self.terminal.SetDamageTracking(False)
+
+        self.stream = ptty.spawn(cmd_path)
+        self.stream.setwinsize(rows, cols)
+        set_non_blocking(self.stream.fileno())
+        self.init_reader(self.stream.fileno())
+        self.write_queue = writequeue.WriteQueue(self.stream.fileno(),
+                                                 self.encoding)
+        self.eof = False
+
+        self.clients = []
+        self.watchers = []
+        # generation of every row as last sent to the clients, and lines
+        # scrolled since then
+        self.sent_generation = []
+        self.pending_scroll = 0
+        # lines scrolled off the top since then, as encode_cells returns
+        self.scrolled = collections.deque()
+        self.sent_attrs = set()
+        self.sent_cursor = None
+        self.title = None
+        self.title_changed = False
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def read(self):
+        """
+        Parses what the child wrote. Returns False once the pty is closed.
+        """
+        self.wakeups += 1
+        data, count, broken_pipe = self.drain(self.read_budget)
+        output = self.decode_input(data)
+        if output:
+            self.terminal.ProcessInput(output)
+        if broken_pipe:
+            self.eof = True
+        return not broken_pipe
+
+    def attach(self, client):
+        # the clients attached already get what's pending, from then on
+        # they and the new one are in step
+        self.flush()
+        if not self.clients:
+            self.terminal.SetDamageTracking(True)
+        self.clients.append(client)
+        client.session = self
+        client.send(self.snapshot())
+
+    def watch(self, client):
+        client.session = self
+        client.encoder = reencode.FrameEncoder()
+        self.watchers.append(client)
+        self.update_watchers()
+
+    def detach(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+        if client in self.watchers:
+            self.watchers.remove(client)
+            client.encoder = None
+            client.stale = False
+        client.session = None
+        if not self.clients:
+            self.terminal.SetDamageTracking(False)
+
+    def resize(self, rows, cols):
+        if self.terminal.GetSize() == (rows, cols):
+            return
+        self.terminal.Resize(rows, cols)
+        self.stream.setwinsize(rows, cols)
+        snapshot = self.snapshot()
+        for client in self.clients:
+            client.send(snapshot)
+        self.update_watchers()
+
+    def snapshot(self):
+        """
+        Returns the message with the whole screen, the damage tracking
+        starts over from it.
+        """
+        snapshot = self.terminal.Snapshot()
+        rows, cols = snapshot.GetSize()
+        generation = self.terminal.NewGeneration()
+        self.sent_generation = [generation] * rows
+        self.pending_scroll = 0
+        self.scrolled.clear()
+
+        lines = []
+        for row in xrange(rows):
+            text, runs = encode_cells(snapshot.screen[row],
+                                      snapshot.scrRendition[row])
+            lines.append([row, 0, text, runs])
+
+        table = self.terminal.GetRenditionTable()
+        self.sent_attrs = set(table)
+        self.sent_cursor = snapshot.GetCursorPos()
+        self.title_changed = False
+        return {"op": "snapshot",
+                "rows": rows,
+                "cols": cols,
+                "cursor": list(self.sent_cursor),
+                "lines": lines,
+                "attrs": [[attr_id, key]
+                          for attr_id, key in table.iteritems()],
+                "title": self.title,
+                "bracketed_paste": self.terminal.IsBracketedPaste()}
+
+    def damage(self):
+        """
+        Returns the message with what changed since the last one, or None
+        if nothing did.
+        """
+        generation = self.terminal.NewGeneration()
+        rows = self.terminal.GetRows()
+        screen = self.terminal.GetRawScreen()
+        scrRendition = self.terminal.GetRawScreenRendition()
+
+        lines = []
+        for row in xrange(rows):
+            sent = self.sent_generation[row]
+            if self.terminal.GetLineGeneration(row) <= sent:
+                continue
+            span = self.terminal.GetLineSpan(row, sent)
+            if span is not None:
+                end = span[1] + 1
+                text, runs = encode_cells(screen[row][span[0]:end],
+                                          scrRendition[row][span[0]:end])
+                lines.append([row, span[0], text, runs])
+            self.sent_generation[row] = generation
+
+        cursor = self.terminal.GetCursorPos()
+        if (not lines and not self.pending_scroll and
+                cursor == self.sent_cursor and not self.title_changed):
+            return None
+
+        attrs = []
+        table = self.terminal.GetRenditionTable()
+        for attr_id, key in table.iteritems():
+            if attr_id not in self.sent_attrs:
+                attrs.append([attr_id, key])
+                self.sent_attrs.add(attr_id)
+
+        message = {"op": "damage",
+                   "scroll": self.pending_scroll,
+                   "history": list(self.scrolled),
+                   "cursor": list(cursor),
+                   "lines": lines,
+                   "attrs": attrs,
+                   "bracketed_paste": self.terminal.IsBracketedPaste()}
+        if self.title_changed:
+            message["title"] = self.title
+            self.title_changed = False
+        self.pending_scroll = 0
+        self.scrolled.clear()
+        self.sent_cursor = cursor
+        return message
+
+    def flush(self):
+        """
+        Sends the clients what changed.
+        """
+        if self.clients:
+            message = self.damage()
+            if message is not None:
+                for client in self.clients:
+                    client.send(message)
+        self.update_watchers()
+
+    def update_watchers(self):
+        """
+        Sends the watchers that read their last frame the current one.
+        """
+        snapshot = None
+        for client in self.watchers:
+            if client.output:
+                client.stale = True
+                continue
+            if snapshot is None:
+                snapshot = self.terminal.Snapshot()
+            client.stale = False
+            data = client.encoder.encode(snapshot)
+            if data:
+                client.send({"op": "vt", "data": data})
+
+    def _scroll_up(self):
+        if not self.clients:
+            return
+        self.pending_scroll += 1
+        # called before the top line goes
+        screen = self.terminal.GetRawScreen()
+        scrRendition = self.terminal.GetRawScreenRendition()
+        self.scrolled.append(encode_cells(screen[0], scrRendition[0]))
+        if len(self.scrolled) > max(self.history_size,
+                                    self.terminal.GetRows()):
+            self.scrolled.popleft()
+        if self.sent_generation:
+            self.sent_generation.pop(0)
+            self.sent_generation.append(-1)
+
+    def _set_title(self, title):
+        self.title = title
+        self.title_changed = True
+
+
+class SessionDaemon(object):
+    """
+    Serves the sessions on a Unix socket from a single thread.
+    """
+    def __init__(self, path, default_cmd="/bin/bash"):
+        self.path = path
+        self.default_cmd = default_cmd
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(8)
+        self.listener.setblocking(False)
+
+        # name: DaemonSession
+        self.sessions = {}
+        self.connections = []
+
+        # SIGCHLD wakes select up through this pipe
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        set_non_blocking(self.wakeup_read)
+        set_non_blocking(self.wakeup_write)
+        signal.set_wakeup_fd(self.wakeup_write)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+        self.running = True
+
+    def serve_forever(self):
+        try:
+            while self.running:
+                self.poll()
+        finally:
+            self.close()
+
+    def poll(self, timeout=None):
+        readers = [self.listener, self.wakeup_read] + self.connections
+        readers.extend(session for session in self.sessions.itervalues()
+                       if not session.eof)
+        writers = [connection for connection in self.connections
+                   if connection.output]
+        writers.extend(session for session in self.sessions.itervalues()
+                       if session.write_queue.wants_write())
+        try:
+            readable, writable, _ = select.select(readers, writers, [],
+                                                  timeout)
+        except select.error, err:
+            if err[0] == EINTR:
+                return
+            raise
+
+        for item in writable:
+            if isinstance(item, Connection):
+                if not item.flush():
+                    self._drop(item)
+                elif (item.stale and not item.output and
+                      item.session is not None):
+                    item.session.update_watchers()
+            else:
+                item.write_queue.flush()
+
+        changed = set()
+        for item in readable:
+            if item is self.listener:
+                self._accept()
+            elif item is self.wakeup_read:
+                self._reap()
+            elif isinstance(item, Connection):
+                if item in self.connections:
+                    self._receive(item)
+            elif not item.read():
+                changed.add(item)
+                self._reap()
+            else:
+                changed.add(item)
+
+        # one damage message per session and poll, however many reads
+        for session in changed:
+            session.flush()
+
+    def close(self):
+        for session in self.sessions.values():
+            session.stream.terminate(True)
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error, err:
+            if err.errno in (EAGAIN, EINTR):
+                return
+            raise
+        self.connections.append(Connection(sock))
+
+    def _drop(self, connection):
+        if connection.session is not None:
+            connection.session.detach(connection)
+        self.connections.remove(connection)
+        connection.sock.close()
+
+    def _receive(self, connection):
+        try:
+            messages = connection.receive()
+            if messages is not None:
+                for message in messages:
+                    self._handle(connection, message)
+                return
+        except (KeyError, TypeError, ValueError):
+            # a malformed message only costs its client the connection,
+            # not every session the daemon runs
+            pass
+        self._drop(connection)
+
+    def _handle(self, connection, message):
+        if not isinstance(message, dict):
+            raise ValueError("message is not an object")
+        op = message.get("op")
+        session = connection.session
+        if op == "attach":
+            if session is not None:
+                session.detach(connection)
+            name = message.get("name") or "default"
+            session = self.sessions.get(name)
+            if session is None:
+                session = DaemonSession(name,
+                                        message.get("cmd") or
+                                        self.default_cmd,
+                                        *self._size(message))
+                self.sessions[name] = session
+            else:
+                session.resize(*self._size(message))
+            session.attach(connection)
+        elif op == "watch":
+            if session is not None:
+                session.detach(connection)
+            session = self.sessions.get(message.get("name") or "default")
+            if session is None:
+                connection.send({"op": "exit", "status": None})
+            else:
+                session.watch(connection)
+        elif op == "list":
+            connection.send({"op": "sessions",
+                             "names": sorted(self.sessions)})
+        elif session is None:
+            return
+        elif connection.encoder is not None:
+            # watchers are read only
+            if op == "detach":
+                session.detach(connection)
+        elif op == "input":
+            session.write_queue.put(message["data"])
+        elif op == "paste":
+            session.write_queue.paste(message["data"],
+                                      message.get("bracketed", False))
+        elif op == "resize":
+            session.resize(*self._size(message))
+        elif op == "detach":
+            session.detach(connection)
+        elif op == "kill":
+            session.stream.terminate(True)
+            self._reap()
+
+    def _size(self, message):
+        rows, cols = int(message["rows"]), int(message["cols"])
+        if rows < 1 or cols < 1:
+            raise ValueError("bad terminal size %dx%d" % (rows, cols))
+        return rows, cols
+
+    def _reap(self):
+        try:
+            while os.read(self.wakeup_read, 512):
+                pass
+        except OSError, err:
+            if err.errno != EAGAIN:
+                raise
+
+        for name, session in self.sessions.items():
+            if session.stream.isalive():
+                continue
+            # what the child wrote right before exiting is still in the pty
+            while not session.eof:
+                data, count, broken_pipe = session.drain(session.read_budget)
+                output = session.decode_input(data)
+                if output:
+                    session.terminal.ProcessInput(output)
+                if broken_pipe or count < session.read_budget:
+                    break
+            session.flush()
+
+            status = session.stream.exitstatus
+            if status is None:
+                status = -session.stream.signalstatus
+            for client in session.clients + session.watchers:
+                client.send({"op": "exit", "status": status})
+                session.detach(client)
+            del self.sessions[name]
+
+
+class TerminalReplica(object):
+    """
+    Keeps a V102Terminal in step with a daemon session by applying its
+    messages. The lines that scrolled off go through the top row and
+    ScrollUp, so the replica builds its own history and its callbacks are
+    called as if it parsed the output.
+    """
+    def __init__(self, terminal):
+        self.terminal = terminal
+        # daemon attribute id: rendition
+        self.renditions = {0: None}
+
+    def apply(self, message):
+        op = message["op"]
+        terminal = self.terminal
+        for attr_id, key in message.get("attrs", ()):
+            self.renditions[attr_id] = emuvt100.Rendition.from_key(
+                tuple(key))
+
+        if op == "snapshot":
+            if terminal.GetSize() != (message["rows"], message["cols"]):
+                terminal.Resize(message["rows"], message["cols"])
+        # past the lines sent the whole screen was scrolled away, and it's
+        # all in the damage
+        for text, runs in message.get("history", ()):
+            terminal.ClearRect(0, 0, 0, terminal.GetCols() - 1)
+            self._put_line(0, 0, text, runs)
+            terminal.ScrollUp()
+
+        for row, first_col, text, runs in message.get("lines", ()):
+            self._put_line(row, first_col, text, runs)
+
+        if "bracketed_paste" in message:
+            terminal.bracketedPaste = message["bracketed_paste"]
+        if message.get("title") is not None:
+            callback = terminal.callbacks[
+                terminal.CALLBACK_UPDATE_WINDOW_TITLE]
+            if callback is not None:
+                callback(message["title"])
+        if "cursor" in message:
+            terminal.SetCursorPos(*message["cursor"])
+
+    def _put_line(self, row, first_col, text, runs):
+        # damage sent before the daemon took a resize can be for a bigger
+        # screen than the terminal has now, the snapshot for the new size
+        # follows
+        rows, cols = self.terminal.GetSize()
+        if row >= rows or first_col >= cols:
+            return
+        renditions = []
+        for attr_id, count in runs:
+            renditions.extend([self.renditions[attr_id]] * count)
+        width = cols - first_col
+        self.terminal.PutCells(row, first_col, list(text)[:width],
+                               renditions[:width])
+
+
+def watch(path, name, output=sys.stdout):
+    """
+    Shows a session of the daemon listening on path, read only, on the
+    terminal output goes to.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(encode_message({"op": "watch", "name": name}))
+    buffer = MessageBuffer()
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        for message in buffer.feed(data):
+            if message["op"] == "exit":
+                return
+            if message["op"] == "vt":
+                output.write(message["data"].encode("utf-8"))
+        output.flush()
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[2] == "--watch":
+        watch(sys.argv[1], sys.argv[3])
+        return
+    if len(sys.argv) != 2:
+        print "usage: %s SOCKET_PATH [--watch NAME]" % sys.argv[0]
+        sys.exit(2)
+    SessionDaemon(sys.argv[1]).serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,532 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Runs the pty reading and the emulation in a child process, which publishes
+the grid in shared memory for the GUI process to map and render:
+
+    python emuprocess.py ROWS COLS CMD
+
+with the shared memory open as fd 3 and the write end of a pipe as fd 4.
+The child writes a byte to the pipe after publishing a frame, takes
+commands from its stdin and tells the title and its exit on its stdout,
+as daemon messages.
+
+The memory holds a header, the frame every row last changed in, the
+rendition table (attr id: Rendition.key()), the characters and attr ids of
+the cells and a ring with the last lines scrolled off the top. The writer
+makes the sequence no. in the header odd while it publishes and even again
+once done; a reader copies what changed and starts over if the sequence
+no. wasn't even or changed meanwhile. On a scroll the writer moves the
+rows up and puts the line that went into the ring; the reader puts each
+line it missed from the ring into its top row and scrolls it off, so its
+history gets the real lines, and then only copies the rows changed since
+the frame it read last. Lines older than the ring are gone, the whole
+screen changed by then anyway.
+"""
+import collections
+from array import array
+from errno import EAGAIN, EINTR
+import fcntl
+import mmap
+import os
+import resource
+import select
+import struct
+import subprocess
+import sys
+import tempfile
+import daemon
+import emuvt100
+import ptty
+import ptyreader
+import writequeue
+
+MAX_ROWS = 256
+MAX_COLS = 1024
+MAX_ATTRS = 4096
+HISTORY_LINES = 512
+
+SEQ = struct.Struct("<I")
+# frame, rows, cols, cursor row and col, lines scrolled, attr count,
+# flags, bytes read
+FIELDS = struct.Struct("<8IQ")
+KEY = struct.Struct("<7b")
+HEADER_SIZE = 64
+
+FLAG_BRACKETED_PASTE = 1
+
+
+class SharedGrid(object):
+    """
+    Layout of a grid of up to max_rows by max_cols cells in buffer.
+    """
+    def __init__(self, buffer, max_rows=MAX_ROWS, max_cols=MAX_COLS,
+                 max_attrs=MAX_ATTRS, history_lines=HISTORY_LINES):
+        self.buffer = buffer
+        self.max_rows = max_rows
+        self.max_cols = max_cols
+        self.max_attrs = max_attrs
+        self.history_lines = history_lines
+
+        self.generations_offset = HEADER_SIZE
+        self.attrs_offset = self.generations_offset + 4 * max_rows
+        self.codes_offset = self.attrs_offset + KEY.size * max_attrs
+        self.cell_attrs_offset = self.codes_offset + 4 * max_rows * max_cols
+        # the history ring, its lines have the width they had at the time
+        self.widths_offset = (self.cell_attrs_offset +
+                              2 * max_rows * max_cols)
+        self.history_codes_offset = self.widths_offset + 2 * history_lines
+        self.history_attrs_offset = (self.history_codes_offset +
+                                     4 * history_lines * max_cols)
+
+    @staticmethod
+    def size(max_rows=MAX_ROWS, max_cols=MAX_COLS, max_attrs=MAX_ATTRS,
+             history_lines=HISTORY_LINES):
+        return (HEADER_SIZE + 4 * max_rows + KEY.size * max_attrs +
+                6 * max_rows * max_cols + 2 * history_lines +
+                6 * history_lines * max_cols)
+
+    def encode_line(self, chars, renditions):
+        """
+        Returns the code points and attr ids of a line as strings.
+        """
+        codes = array("I", [ord(char) for char in chars]).tostring()
+        ids = array("H", [rendition.attr_id
+                          if rendition is not None and
+                          rendition.attr_id < self.max_attrs else 0
+                          for rendition in renditions]).tostring()
+        return codes, ids
+
+
+class GridWriter(SharedGrid):
+    """
+    Publishes the screen of a V102Terminal.
+    """
+    def __init__(self, buffer, **kwargs):
+        super(GridWriter, self).__init__(buffer, **kwargs)
+        self.seq = 0
+        self.frame = 0
+        self.scroll = 0
+        self.attr_count = 0
+        self.size = None
+        # terminal generation published last
+        self.published = -1
+
+    def publish(self, terminal, scrolls=0, bytes_read=0, history=()):
+        """
+        Publishes the rows changed since the last call, scrolls being the
+        lines the terminal scrolled meanwhile and history the last of the
+        lines scrolled off, as (chars, renditions), oldest first.
+        """
+        generation = terminal.NewGeneration()
+        rows, cols = terminal.GetSize()
+        full = (rows, cols) != self.size
+        self.size = rows, cols
+
+        self.seq += 1
+        SEQ.pack_into(self.buffer, 0, self.seq)
+        self.frame += 1
+
+        if scrolls and not full and scrolls < rows:
+            self._move_rows(scrolls, rows)
+        self.scroll = (self.scroll + scrolls) & 0xffffffff
+        history = list(history)[-min(scrolls, self.history_lines):] \
+            if scrolls else []
+        for index, (chars, renditions) in enumerate(history):
+            self._write_history_line(self.scroll - len(history) + index,
+                                     chars, renditions)
+
+        screen = terminal.GetRawScreen()
+        scrRendition = terminal.GetRawScreenRendition()
+        for row in xrange(rows):
+            if full or terminal.GetLineGeneration(row) > self.published:
+                self._write_row(row, screen[row], scrRendition[row])
+
+        table = terminal.GetRenditionTable()
+        while self.attr_count < min(len(table), self.max_attrs - 1):
+            self.attr_count += 1
+            KEY.pack_into(self.buffer,
+                          self.attrs_offset + KEY.size * self.attr_count,
+                          *table[self.attr_count])
+
+        flags = 0
+        if terminal.IsBracketedPaste():
+            flags |= FLAG_BRACKETED_PASTE
+        cur_row, cur_col = terminal.GetCursorPos()
+        FIELDS.pack_into(self.buffer, SEQ.size, self.frame, rows, cols,
+                         cur_row, cur_col, self.scroll, self.attr_count,
+                         flags, bytes_read)
+
+        self.seq += 1
+        SEQ.pack_into(self.buffer, 0, self.seq)
+        self.published = generation
+
+    def _move_rows(self, count, rows):
+        stride = self.max_cols
+        for offset, size in ((self.codes_offset, 4 * stride),
+                             (self.cell_attrs_offset, 2 * stride),
+                             (self.generations_offset, 4)):
+            self.buffer.move(offset, offset + count * size,
+                             (rows - count) * size)
+
+    def _write_row(self, row, chars, renditions):
+        codes, ids = self.encode_line(chars, renditions)
+        start = self.codes_offset + 4 * self.max_cols * row
+        self.buffer[start:start + len(codes)] = codes
+        start = self.cell_attrs_offset + 2 * self.max_cols * row
+        self.buffer[start:start + len(ids)] = ids
+
+        struct.pack_into("<I", self.buffer,
+                         self.generations_offset + 4 * row, self.frame)
+
+    def _write_history_line(self, index, chars, renditions):
+        slot = index % self.history_lines
+        codes, ids = self.encode_line(chars[:self.max_cols],
+                                      renditions[:self.max_cols])
+        start = self.history_codes_offset + 4 * self.max_cols * slot
+        self.buffer[start:start + len(codes)] = codes
+        start = self.history_attrs_offset + 2 * self.max_cols * slot
+        self.buffer[start:start + len(ids)] = ids
+        struct.pack_into("<H", self.buffer, self.widths_offset + 2 * slot,
+                         len(ids) / 2)
+
+
+class GridReader(SharedGrid):
+    """
+    Copies what a GridWriter published into a local V102Terminal.
+    """
+    def __init__(self, buffer, **kwargs):
+        super(GridReader, self).__init__(buffer, **kwargs)
+        self.frame = 0
+        self.scroll = None
+        self.size = None
+        self.bytes_read = 0
+        # attr id: rendition
+        self.renditions = [None]
+        # reads started over because the writer was busy
+        self.retries = 0
+
+    def read(self, terminal, attempts=8):
+        """
+        Applies the latest frame to terminal, through ScrollUp and PutCells
+        so its damage tracking and callbacks see the changes. Returns
+        whether anything changed and whether the size of the frames did.
+
+        The widget resizes terminal before the child gets to resize its
+        own, frames of the old size are fitted the way Resize would: rows
+        are dropped at the top and columns at the right.
+        """
+        for attempt in xrange(attempts):
+            seq, = SEQ.unpack_from(self.buffer, 0)
+            if seq & 1:
+                self.retries += 1
+                continue
+            (frame, rows, cols, cur_row, cur_col, scroll, attr_count, flags,
+             bytes_read) = FIELDS.unpack_from(self.buffer, SEQ.size)
+            if frame == self.frame:
+                return False, False
+
+            full = (rows, cols) != self.size
+            generations = array("I")
+            generations.fromstring(
+                self.buffer[self.generations_offset:
+                            self.generations_offset + 4 * rows])
+            lines = []
+            for row in xrange(rows):
+                if full or generations[row] > self.frame:
+                    start = self.codes_offset + 4 * self.max_cols * row
+                    codes = self.buffer[start:start + 4 * cols]
+                    start = self.cell_attrs_offset + 2 * self.max_cols * row
+                    ids = self.buffer[start:start + 2 * cols]
+                    lines.append((row, codes, ids))
+            keys = [KEY.unpack_from(self.buffer,
+                                    self.attrs_offset + KEY.size * attr_id)
+                    for attr_id in xrange(len(self.renditions),
+                                          attr_count + 1)]
+            history = []
+            if not full and self.scroll is not None:
+                scrolls = (scroll - self.scroll) & 0xffffffff
+                for index in xrange(scroll - min(scrolls, self.history_lines),
+                                    scroll):
+                    history.append(self._read_history_line(index))
+
+            if SEQ.unpack_from(self.buffer, 0)[0] == seq:
+                break
+            self.retries += 1
+        else:
+            # the wakeup of the frame being written comes next
+            return False, False
+
+        for key in keys:
+            self.renditions.append(emuvt100.Rendition.from_key(key))
+        local_rows, local_cols = terminal.GetSize()
+        offset = max(rows - local_rows, 0)
+        for codes, ids in history:
+            chars = map(unichr, array("I", codes)[:local_cols])
+            renditions = map(self.renditions.__getitem__,
+                             array("H", ids)[:local_cols])
+            padding = local_cols - len(chars)
+            self._put_row(terminal, 0, chars + [u" "] * padding,
+                          renditions + [None] * padding,
+                          terminal.GetRawScreen()[0],
+                          terminal.GetRawScreenRendition()[0])
+            terminal.ScrollUp()
+
+        screen = terminal.GetRawScreen()
+        scrRendition = terminal.GetRawScreenRendition()
+        for row, codes, ids in lines:
+            row -= offset
+            if row < 0 or row >= local_rows:
+                continue
+            chars = map(unichr, array("I", codes)[:local_cols])
+            renditions = map(self.renditions.__getitem__,
+                             array("H", ids)[:local_cols])
+            self._put_row(terminal, row, chars, renditions, screen[row],
+                          scrRendition[row])
+
+        terminal.SetCursorPos(cur_row - offset, cur_col)
+        terminal.bracketedPaste = bool(flags & FLAG_BRACKETED_PASTE)
+        self.frame = frame
+        self.scroll = scroll
+        self.size = rows, cols
+        self.bytes_read = bytes_read
+        return True, full
+
+    def _read_history_line(self, index):
+        slot = index % self.history_lines
+        width, = struct.unpack_from("<H", self.buffer,
+                                    self.widths_offset + 2 * slot)
+        start = self.history_codes_offset + 4 * self.max_cols * slot
+        codes = self.buffer[start:start + 4 * width]
+        start = self.history_attrs_offset + 2 * self.max_cols * slot
+        return codes, self.buffer[start:start + 2 * width]
+
+    def _put_row(self, terminal, row, chars, renditions, old_chars,
+                 old_renditions):
+        # only the cells that differ are put, the rest stays undamaged
+        def same(col):
+            if chars[col] != old_chars[col]:
+                return False
+            new, old = renditions[col], old_renditions[col]
+            return new is old or (new is not None and old is not None and
+                                  new.key() == old.key())
+
+        cols = len(chars)
+        first = 0
+        while first < cols and same(first):
+            first += 1
+        if first == cols:
+            return
+        last = cols - 1
+        while same(last):
+            last -= 1
+        terminal.PutCells(row, first, chars[first:last + 1],
+                          renditions[first:last + 1])
+
+
+class EmulatorProcess(ptyreader.PtyReader):
+    """
+    The child side: reads the pty, parses the output and publishes the
+    grid after every read.
+    """
+    def __init__(self, grid, wake_fd, cmd_path, rows, cols):
+        rows, cols = min(rows, MAX_ROWS), min(cols, MAX_COLS)
+        self.terminal = emuvt100.V102Terminal(rows, cols)
+        self.terminal.SetCallback(self.terminal.CALLBACK_SCROLL_UP_SCREEN,
+                                  self._scroll_up)
+        self.terminal.SetCallback(
+            self.terminal.CALLBACK_UPDATE_WINDOW_TITLE, self._set_title)
+        self.scrolls = 0
+        # the last lines scrolled off since the last frame
+        self.history = collections.deque(maxlen=HISTORY_LINES)
+
+        self.grid = GridWriter(grid)
+        self.wake_fd = wake_fd
+        daemon.set_non_blocking(wake_fd)
+
+        self.stream = ptty.spawn(cmd_path)
+        self.stream.setwinsize(rows, cols)
+        daemon.set_non_blocking(self.stream.fileno())
+        self.init_reader(self.stream.fileno())
+        self.write_queue = writequeue.WriteQueue(self.stream.fileno(),
+                                                 self.encoding)
+        self.eof = False
+
+        self.commands = daemon.MessageBuffer()
+        self.output = ""
+        self.running = True
+
+    def run(self):
+        pty_fd = self.stream.fileno()
+        self.publish()
+        while self.running:
+            readers = [sys.stdin]
+            if not self.eof:
+                readers.append(pty_fd)
+            writers = []
+            if self.write_queue.wants_write():
+                writers.append(pty_fd)
+            if self.output:
+                writers.append(sys.stdout)
+            try:
+                readable, writable, _ = select.select(
+                    readers, writers, [], 0.1 if self.eof else None)
+            except select.error, err:
+                if err[0] == EINTR:
+                    continue
+                raise
+
+            if pty_fd in writable:
+                self.write_queue.flush()
+            if sys.stdout in writable:
+                self._flush_output()
+            if pty_fd in readable:
+                self.read()
+            if sys.stdin in readable:
+                self._receive()
+            if self.eof and not self.stream.isalive():
+                self._exit()
+
+    def read(self):
+        data, count, broken_pipe = self.drain(self.read_budget)
+        output = self.decode_input(data)
+        if output:
+            self.terminal.ProcessInput(output)
+            self.publish()
+        if broken_pipe:
+            self.eof = True
+
+    def publish(self):
+        self.grid.publish(self.terminal, self.scrolls, self.bytes_read,
+                          self.history)
+        self.scrolls = 0
+        self.history.clear()
+        try:
+            os.write(self.wake_fd, "\0")
+        except OSError, err:
+            # the pipe is full, the GUI hasn't taken the last wakeups
+            if err.errno != EAGAIN:
+                raise
+
+    def send(self, message):
+        self.output += daemon.encode_message(message)
+        self._flush_output()
+
+    def _flush_output(self):
+        try:
+            written = os.write(sys.stdout.fileno(), self.output)
+        except OSError, err:
+            if err.errno != EAGAIN:
+                raise
+            written = 0
+        self.output = self.output[written:]
+
+    def _receive(self):
+        data = os.read(sys.stdin.fileno(), 65536)
+        if not data:
+            # the GUI is gone
+            self.stream.terminate(True)
+            self.running = False
+            return
+        for message in self.commands.feed(data):
+            op = message["op"]
+            if op == "input":
+                self.write_queue.put(message["data"])
+            elif op == "paste":
+                self.write_queue.paste(message["data"],
+                                       message.get("bracketed", False))
+            elif op == "resize":
+                self.resize(message["rows"], message["cols"])
+            elif op == "close":
+                self.stream.terminate(True)
+                self.running = False
+
+    def resize(self, rows, cols):
+        rows, cols = min(rows, MAX_ROWS), min(cols, MAX_COLS)
+        if self.terminal.GetSize() == (rows, cols):
+            return
+        self.terminal.Resize(rows, cols)
+        self.stream.setwinsize(rows, cols)
+        self.publish()
+
+    def _exit(self):
+        status = self.stream.exitstatus
+        if status is None:
+            status = -self.stream.signalstatus
+        self.send({"op": "exit", "status": status})
+        while self.output:
+            select.select([], [sys.stdout], [])
+            self._flush_output()
+        self.running = False
+
+    def _scroll_up(self):
+        # called before the top line goes, which is cleared in place
+        self.scrolls += 1
+        self.history.append((self.terminal.GetRawScreen()[0][:],
+                             self.terminal.GetRawScreenRendition()[0][:]))
+
+    def _set_title(self, title):
+        self.send({"op": "title", "title": title})
+
+
+def start(cmd_path, rows, cols):
+    """
+    Runs cmd_path in a new emulator process. Returns the subprocess.Popen,
+    a GridReader of its grid and the fd its wakeups are read from.
+    """
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    grid_fd, path = tempfile.mkstemp(prefix="haikuterm-", dir=directory)
+    os.unlink(path)
+    size = SharedGrid.size()
+    os.ftruncate(grid_fd, size)
+    grid = mmap.mmap(grid_fd, size)
+    wake_read, wake_write = os.pipe()
+    daemon.set_non_blocking(wake_read)
+
+    def pass_fds():
+        # the child gets the grid and the pipe as fds 3 and 4, and none of
+        # the other fds of the GUI, e.g. the ptys of other sessions
+        high = [fcntl.fcntl(fd, fcntl.F_DUPFD, 10)
+                for fd in (grid_fd, wake_write)]
+        os.dup2(high[0], 3)
+        os.dup2(high[1], 4)
+        os.closerange(5, resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+
+    script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+    process = subprocess.Popen([sys.executable, script, str(rows), str(cols),
+                                cmd_path],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               preexec_fn=pass_fds)
+    os.close(grid_fd)
+    os.close(wake_write)
+    return process, GridReader(grid), wake_read
+
+
+def main():
+    if len(sys.argv) != 4:
+        print "usage: %s ROWS COLS CMD" % sys.argv[0]
+        sys.exit(2)
+    grid = mmap.mmap(3, SharedGrid.size())
+    daemon.set_non_blocking(sys.stdout.fileno())
+    EmulatorProcess(grid, 4, sys.argv[3], int(sys.argv[1]),
+                    int(sys.argv[2])).run()
+
+if __name__ == '__main__':
+    main()
@@ -35,6 +35,7 @@ graphics rendition which specifies text style(i.e. bold, italics), foreground
 color and background color. The handled escape sequences are CUU, CUD, CUF,
 CUB, CHA, CUP, ED, EL, VPA and SGR.
 """
+import collections
 import sys
 
 class Rendition(object):
@@ -49,6 +50,34 @@ class Rendition(object):
         self.font = 0
         self.intensity = 0
 
+        # set when the terminal interns the rendition, 0 is reserved for
+        # cells without rendition
+        self.attr_id = 0
+
+    def copy(self):
+        rendition = Rendition()
+        rendition.__dict__.update(self.__dict__)
+        rendition.attr_id = 0
+        return rendition
+
+    def key(self):
+        """
+        Returns a tuple identifying the visible attributes of the rendition.
+        """
+        return (self.blinking, self.italic, self.underline, self.bg_color,
+                self.fg_color, self.font, self.intensity)
+
+    @classmethod
+    def from_key(cls, key):
+        """
+        Returns a new rendition with the attributes of a key() tuple.
+        """
+        rendition = cls()
+        (rendition.blinking, rendition.italic, rendition.underline,
+         rendition.bg_color, rendition.fg_color, rendition.font,
+         rendition.intensity) = key
+        return rendition
+
     def swap_colors(self):
         self.bg_color, self.fg_color = self.fg_color, self.bg_color
 
@@ -79,6 +108,56 @@ class Rendition(object):
                 self.font == other.font and
                 self.intensity == other.intensity)
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+class TerminalSnapshot(object):
+    """
+    Immutable copy of the terminal screen taken by V102Terminal.Snapshot.
+    Its lines are the terminal's lists at the time of the snapshot, readers
+    must not modify them.
+    """
+    def __init__(self, terminal):
+        self.rows = terminal.rows
+        self.cols = terminal.cols
+        self.curY, self.curX = terminal.GetCursorPos()
+        self.generation = terminal.generation
+        self.screen = tuple(terminal.screen)
+        self.scrRendition = tuple(terminal.scrRendition)
+        self.lineGeneration = tuple(spans[-1][0]
+                                    for spans in terminal.lineSpans)
+
+    def GetSize(self):
+        """
+        Returns rows and cols as tuple
+        """
+        return self.rows, self.cols
+
+    def GetCursorPos(self):
+        """
+        Returns cursor position as tuple
+        """
+        return self.curY, self.curX
+
+    def GetChar(self, row, col):
+        return self.screen[row][col]
+
+    def GetRendition(self, row, col):
+        return self.scrRendition[row][col]
+
+    def GetLine(self, lineno):
+        """
+        Returns the line specified by lineno as string
+        """
+        return u"".join(self.screen[lineno])
+
+    def GetLineGeneration(self, lineno):
+        """
+        Returns the generation the line specified by lineno was last changed
+        in, as of the snapshot.
+        """
+        return self.lineGeneration[lineno]
+
 class V102Terminal:
     __ASCII_NUL = 0     # Null
     __ASCII_BEL = 7     # Bell
@@ -128,6 +207,13 @@ class V102Terminal:
                         # as CSI 0 m (reset / normal), which is typical of most
                         # of the ANSI codes.
     
+    __ESCSEQ_SM = 'h'   # ? n [;k] h: Sets DEC private modes. Only 2004,
+                        # bracketed paste, is tracked.
+    
+    __ESCSEQ_RM = 'l'   # ? n [;k] l: Resets DEC private modes.
+    
+    __DECMODE_BRACKETED_PASTE = 2004
+    
     RENDITION_STYLE_BOLD = 1
     RENDITION_STYLE_DIM = 2
     RENDITION_STYLE_ITALIC = 4
@@ -184,8 +270,13 @@ class V102Terminal:
                                self.__ESCSEQ_EL:self.__OnEscSeqEL,
                                self.__ESCSEQ_VPA:self.__OnEscSeqVPA,
                                self.__ESCSEQ_SGR:self.__OnEscSeqSGR,
+                               self.__ESCSEQ_SM:self.__OnEscSeqSM,
+                               self.__ESCSEQ_RM:self.__OnEscSeqRM,
                               }
 
+        # whether the application asked for pastes to be bracketed
+        self.bracketedPaste = False
+
         # terminal screen, its a list of string in which each string always
         # holds self.cols characters. If the screen doesn't contain any 
         # character then it'll blank space
@@ -198,11 +289,30 @@ class V102Terminal:
         self.scrRendition = []
 
 
+        # interned renditions by Rendition.key(). Renditions stored in the
+        # screen are shared between cells and never modified, SGR works on
+        # a copy of the current one.
+        self.renditions = {}
+
         # current rendition
-        self.curRendition = Rendition()
+        self.curRendition = self.__InternRendition(Rendition())
+
+        # lines scrolled off the top of the screen, oldest first. Each item
+        # is a (line, rendition) tuple of lists as they were in the screen.
+        self.history = collections.deque(maxlen=0)
         
         # list of dirty lines since last call to GetDirtyLines
         self.isLineDirty = []
+
+        # generation of the changes made from now on, see NewGeneration
+        self.generation = 1
+
+        # changed columns of every line, a short list of [generation,
+        # startCol, endCol] items sorted by generation. The last item holds
+        # the generation the line was last changed in.
+        self.lineSpans = []
+        # see SetDamageTracking
+        self.damageTracking = True
         
         for i in range(rows):
             line = []
@@ -215,6 +325,11 @@ class V102Terminal:
             self.screen.append(line)
             self.scrRendition.append(rendition)
             self.isLineDirty.append(False)
+            self.lineSpans.append([[0, 0, cols - 1]])
+
+        # lines referenced by a snapshot, they are copied before being
+        # changed, see Snapshot
+        self.lineShared = [False] * rows
 
         # initializes callbacks
         self.callbacks = {
@@ -228,6 +343,10 @@ class V102Terminal:
         # unparsed part of last input
         self.unparsedInput = None
 
+        # no. of ProcessInput calls and characters processed
+        self.inputChunks = 0
+        self.inputChars = 0
+
     def GetRawScreen(self):
         """
         Returns the screen as a list of strings. The list will have rows no. of
@@ -280,8 +399,12 @@ class V102Terminal:
             # remove rows at top
             for i in range(self.rows - rows):
                 self.isLineDirty.pop(0)
+                self.lineSpans.pop(0)
+                self.lineShared.pop(0)
                 self.screen.pop(0)
                 self.scrRendition.pop(0)
+            # the cursor stays on its line, or on the top one if that's gone
+            self.curY = max(self.curY - (self.rows - rows), 0)
 
         elif rows > self.rows:
             # add blank rows at bottom
@@ -296,29 +419,110 @@ class V102Terminal:
                 self.screen.append(line)
                 self.scrRendition.append(rendition)
                 self.isLineDirty.append(False)
+                self.lineSpans.append([[self.generation, 0, self.cols - 1]])
+                self.lineShared.append(False)
 
         self.rows = rows
 
         if cols < self.cols:
             # remove cols at right
             for i in range(self.rows):
+                self.__UnshareLine(i)
                 self.screen[i] = self.screen[i][:cols - self.cols]
                 for j in range(self.cols - cols):
                     self.scrRendition[i].pop(len(self.scrRendition[i]) - 1)
         elif cols > self.cols:
             # add cols at right
             for i in range(self.rows):
+                self.__UnshareLine(i)
                 for j in range(cols - self.cols):
                     self.screen[i].append(u' ')
                     self.scrRendition[i].append(None)
+                self.__TouchLine(i, self.cols, cols - 1)
 
         self.cols = cols
+        self.curX = min(self.curX, cols)
         
+    def SetHistorySize(self, size):
+        """
+        Sets the maximum no. of lines kept after scrolling off the top of the
+        screen. The oldest lines are discarded first, None keeps them all.
+        """
+        self.history = collections.deque(self.history, maxlen=size)
+
+    def GetHistorySize(self):
+        """
+        Returns the maximum no. of lines kept in the history
+        """
+        return self.history.maxlen
+
+    def GetHistoryLength(self):
+        """
+        Returns the no. of lines currently in the history
+        """
+        return len(self.history)
+
+    def GetHistoryLine(self, index):
+        """
+        Returns the history line specified by index as a (line, rendition)
+        tuple of lists, index 0 being the oldest line. The lists keep the
+        no. of cols the terminal had when the line scrolled off.
+        """
+        return self.history[index]
+
+    def IsBracketedPaste(self):
+        """
+        Returns True if the application wants pastes between ESC [ 200 ~ and
+        ESC [ 201 ~.
+        """
+        return self.bracketedPaste
+
     def GetCursorPos(self):
         """
         Returns cursor position as tuple
         """
         return self.curY, self.curX
+
+    def SetCursorPos(self, row, col):
+        """
+        Moves the cursor to the given position and calls the callback
+        CALLBACK_UPDATE_CURSOR_POS.
+        """
+        self.curY = max(0, min(row, self.rows - 1))
+        self.curX = max(0, min(col, self.cols))
+
+        if self.callbacks[self.CALLBACK_UPDATE_CURSOR_POS] is not None:
+            self.callbacks[self.CALLBACK_UPDATE_CURSOR_POS]()
+
+    def GetRenditionTable(self):
+        """
+        Returns a dict with the key of every rendition used so far, see
+        Rendition.key, by attribute id.
+        """
+        return dict((rendition.attr_id, key)
+                    for key, rendition in self.renditions.iteritems())
+
+    def PutCells(self, lineno, startCol, chars, renditions):
+        """
+        Writes chars and renditions (None for cells without one) into the
+        line specified by lineno from startCol on, without moving the
+        cursor. It's how a copy of another terminal is kept up to date.
+        """
+        endCol = min(startCol + len(chars), self.cols)
+        if endCol <= startCol:
+            return
+
+        self.__UnshareLine(lineno)
+        line = self.screen[lineno]
+        lineRendition = self.scrRendition[lineno]
+        for col in range(startCol, endCol):
+            line[col] = chars[col - startCol]
+            rendition = renditions[col - startCol]
+            if rendition is not None:
+                rendition = self.__InternRendition(rendition)
+            lineRendition[col] = rendition
+        self.__TouchLine(lineno, startCol, endCol - 1)
+        self.isLineDirty[lineno] = True
     
     def Clear(self):
         """
@@ -366,12 +570,14 @@ class V102Terminal:
             elif i == endRow:
                 end = endCol
                 
+            self.__UnshareLine(i)
             for j in range(start, end + 1):
                 self.screen[i][j] = u' '
                 self.scrRendition[i][j] = None
                 
             if end + 1 > start:
                 self.isLineDirty[i] = True 
+                self.__TouchLine(i, start, end)
 
     def GetChar(self, row, col):
         return self.screen[row][col]
@@ -430,6 +636,101 @@ class V102Terminal:
         
         return dirtyLines
 
+    def Snapshot(self):
+        """
+        Returns an immutable TerminalSnapshot of the screen. The snapshot
+        shares the lines with the terminal, which copies a line the next
+        time it changes it, so taking one costs O(rows) whatever the size of
+        the lines.
+        """
+        snapshot = TerminalSnapshot(self)
+        self.lineShared = [True] * self.rows
+        return snapshot
+
+    def __UnshareLine(self, lineno):
+        """
+        Gives the line specified by lineno its own lists if it's shared with
+        a snapshot.
+        """
+        if self.lineShared[lineno]:
+            self.screen[lineno] = self.screen[lineno][:]
+            self.scrRendition[lineno] = self.scrRendition[lineno][:]
+            self.lineShared[lineno] = False
+
+    def NewGeneration(self):
+        """
+        Returns the generation of the changes made so far and starts a new
+        one, every change made after this call gets a higher generation.
+        A renderer calls it before drawing and remembers the returned value
+        for the lines it draws.
+        """
+        generation = self.generation
+        self.generation += 1
+        return generation
+
+    def SetDamageTracking(self, enabled):
+        """
+        Enables or disables recording which columns change. While disabled
+        the screen keeps being updated but GetLineSpan knows nothing about
+        it, enabling it again marks every line as changed in the current
+        generation.
+        """
+        if enabled and not self.damageTracking:
+            for i in range(self.rows):
+                self.lineSpans[i] = [[self.generation, 0, self.cols - 1]]
+        self.damageTracking = enabled
+
+    def GetLineGeneration(self, lineno):
+        """
+        Returns the generation the line specified by lineno was last changed
+        in.
+        """
+        return self.lineSpans[lineno][-1][0]
+
+    def GetLineSpan(self, lineno, since):
+        """
+        Returns the columns of the line specified by lineno changed after the
+        given generation as a (startCol, endCol) tuple, or None if the line
+        didn't change. The span may be wider than what actually changed.
+        """
+        startCol = endCol = None
+        for generation, start, end in self.lineSpans[lineno]:
+            if generation <= since:
+                continue
+            if startCol is None or start < startCol:
+                startCol = start
+            if endCol is None or end > endCol:
+                endCol = end
+
+        if startCol is None:
+            return None
+        return startCol, min(endCol, self.cols - 1)
+
+    def __TouchLine(self, lineno, startCol, endCol):
+        """
+        Records that the columns startCol..endCol of the line specified by
+        lineno changed in the current generation.
+        """
+        if not self.damageTracking:
+            return
+
+        spans = self.lineSpans[lineno]
+        span = spans[-1]
+        if span[0] == self.generation:
+            if startCol < span[1]:
+                span[1] = startCol
+            if endCol > span[2]:
+                span[2] = endCol
+            return
+
+        spans.append([self.generation, startCol, endCol])
+        if len(spans) > 4:
+            # merge the two oldest spans, the result covers both so lines
+            # are never reported narrower than what changed
+            first = spans.pop(0)
+            spans[0][1] = min(first[1], spans[0][1])
+            spans[0][2] = max(first[2], spans[0][2])
+
     def SetCallback(self, event, func):
         """
         Sets callback function for the specified event. The event should be
@@ -470,6 +771,9 @@ class V102Terminal:
         if text is None:
             return
 
+        self.inputChunks += 1
+        self.inputChars += len(text)
+
         if self.unparsedInput is not None:
             text = self.unparsedInput + text
             self.unparsedInput = None
@@ -515,14 +819,32 @@ class V102Terminal:
             self.callbacks[self.CALLBACK_SCROLL_UP_SCREEN]()
             
         line = self.screen.pop(0)
-        for i in range(self.cols):
-            line[i] = u' '
-        self.screen.append(line)
-        
         rendition = self.scrRendition.pop(0)
-        for i in range(self.cols):
-            rendition[i] = None
+        shared = self.lineShared.pop(0)
+        self.lineShared.append(False)
+
+        # maxlen is None for unbounded history
+        if self.history.maxlen != 0:
+            # the lines move to the history as they are, the screen gets new
+            # blank ones
+            self.history.append((line, rendition))
+            line = [u' '] * self.cols
+            rendition = [None] * self.cols
+        elif shared:
+            line = [u' '] * self.cols
+            rendition = [None] * self.cols
+        else:
+            for i in range(self.cols):
+                line[i] = u' '
+                rendition[i] = None
+
+        self.screen.append(line)
         self.scrRendition.append(rendition)
+
+        self.isLineDirty.pop(0)
+        self.isLineDirty.append(False)
+        self.lineSpans.pop(0)
+        self.lineSpans.append([[self.generation, 0, self.cols - 1]])
            
     def Dump(self, file=sys.stdout):
         """
@@ -551,8 +873,11 @@ class V102Terminal:
         if self.curX >= self.cols:
             self.__NewLine()
 
+        if self.lineShared[self.curY]:
+            self.__UnshareLine(self.curY)
         self.screen[self.curY][self.curX] = ch
         self.scrRendition[self.curY][self.curX] = self.curRendition
+        self.__TouchLine(self.curY, self.curX, self.curX)
         self.curX += 1
         
         self.isLineDirty[self.curY] = True
@@ -854,11 +1179,44 @@ class V102Terminal:
         else:
             print "WARNING: VPA line no. out of boundary"
 
+    def __InternRendition(self, rendition):
+        """
+        Returns the shared rendition equal to the given one, giving it an
+        attribute id if it's the first of its kind.
+        """
+        key = rendition.key()
+        interned = self.renditions.get(key)
+        if interned is None:
+            rendition.attr_id = len(self.renditions) + 1
+            self.renditions[key] = interned = rendition
+        return interned
+
+    def __OnEscSeqSM(self, params):
+        """
+        Handler for escape sequence SM
+        """
+        self.__SetPrivateModes(params, True)
+
+    def __OnEscSeqRM(self, params):
+        """
+        Handler for escape sequence RM
+        """
+        self.__SetPrivateModes(params, False)
+
+    def __SetPrivateModes(self, params, value):
+        if params is None or not params.startswith("?"):
+            return
+
+        for mode in params[1:].split(";"):
+            if mode.isdigit() and int(mode) == self.__DECMODE_BRACKETED_PASTE:
+                self.bracketedPaste = value
+
     def __OnEscSeqSGR(self, params):
         """
         Handler for escape sequence SGR
         """
         if params is not None:
+            self.curRendition = self.curRendition.copy()
             renditions = params.split(';')
             for rendition in renditions:
                 irendition = int(rendition)
@@ -868,9 +1226,13 @@ class V102Terminal:
                     self.curRendition = Rendition()
                 elif irendition == 1:
                 #1 	Bright (increased intensity) or Bold
-                    self.curRendition.intensity += 1
+                # bold, normal and faint are all there is, repeating 1 or 2
+                # doesn't go any further
+                    self.curRendition.intensity = min(
+                        self.curRendition.intensity + 1, 1)
                 elif irendition == 2:
-                    self.curRendition.intensity -= 1
+                    self.curRendition.intensity = max(
+                        self.curRendition.intensity - 1, -1)
 
                 #2 	Faint (decreased intensity) 	not widely supported
 
@@ -984,3 +1346,5 @@ class V102Terminal:
 
                 else:
                     print "'%s' not supported" % irendition
+
+            self.curRendition = self.__InternRendition(self.curRendition)
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+import time
+from PyQt4 import QtGui, QtCore
+
+
+class PerformanceHud(object):
+    """
+    Overlay with the performance counters of a terminal: input rate, parse
+    time per chunk, time spent finding the damage and painting per frame,
+    frames rendered and skipped, paint events, and the row cache hit rate.
+
+    The counters are plain integers kept by the session, the emulator and
+    the widget whether the overlay is shown or not. The timings are only
+    taken while it's visible, sample() turns both into rates once per
+    interval.
+    """
+    TEMPLATE = u"frames: 0000/s skipped: 0000/s"
+
+    def __init__(self):
+        self.visible = False
+
+        # seconds spent since the last sample
+        self.parse_time = 0.0
+        self.diff_time = 0.0
+        self.paint_time = 0.0
+
+        self.last_sample = time.time()
+        self.last_counters = {}
+        self.lines = []
+
+    def reset(self, counters):
+        """
+        Starts a new sampling interval from the given counters.
+        """
+        self.parse_time = 0.0
+        self.diff_time = 0.0
+        self.paint_time = 0.0
+        self.last_sample = time.time()
+        self.last_counters = dict(counters)
+
+    def sample(self, counters, hit_rate):
+        """
+        Computes the lines shown from the counters accumulated since the
+        previous sample.
+        """
+        now = time.time()
+        elapsed = max(now - self.last_sample, 0.001)
+        delta = dict((name, value - self.last_counters.get(name, 0))
+                     for name, value in counters.iteritems())
+
+        chunks = max(delta["chunks"], 1)
+        frames = max(delta["frames"], 1)
+        self.lines = [
+            u"input: %.1f KB/s" % (delta["bytes"] / elapsed / 1024),
+            u"parse: %.2f ms/chunk" % (self.parse_time * 1000 / chunks),
+            u"diff: %.2f ms/frame" % (self.diff_time * 1000 / frames),
+            u"paint: %.2f ms/frame" % (self.paint_time * 1000 / frames),
+            u"frames: %d/s skipped: %d/s" % (delta["frames"] / elapsed,
+                                             delta["skipped"] / elapsed),
+            u"paints: %d/s" % (delta["paints"] / elapsed),
+            u"cells: %d/frame" % (delta["cells"] / frames),
+            u"row cache: %d%%" % (hit_rate * 100),
+        ]
+        self.reset(counters)
+
+    def rect(self, bounds, font):
+        """
+        Returns the rectangle of bounds covered by the overlay.
+        """
+        fm = QtGui.QFontMetrics(font)
+        width = fm.width(self.TEMPLATE) + 8
+        height = max(len(self.lines), 1) * fm.height() + 8
+        return QtCore.QRect(bounds.right() - width + 1, bounds.top(),
+                            width, height)
+
+    def draw(self, painter, bounds, font):
+        rect = self.rect(bounds, font)
+        fm = QtGui.QFontMetrics(font)
+        painter.fillRect(rect, QtGui.QColor(0, 0, 0, 192))
+        painter.setFont(font)
+        painter.setPen(QtCore.Qt.white)
+        y = rect.top() + 4 + fm.ascent()
+        for line in self.lines:
+            painter.drawText(QtCore.QPoint(rect.left() + 4, y), line)
+            y += fm.height()
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+import select
+from PyQt4 import QtCore
+import session as session_module
+
+
+class SessionManager(QtCore.QObject):
+    """
+    Reads the ptys of many sessions in the GUI thread from one epoll set,
+    so the event loop watches a single fd whatever the no. of sessions.
+
+    Every wakeup goes round the readable sessions reading at most
+    session_budget bytes from each per round, until they're drained or
+    total_budget bytes were read, so a flooding session can't starve the
+    others. Each session then gets one "receive" with everything read from
+    it, which the widget parses and renders as a single update.
+    """
+    def __init__(self, parent=None, session_budget=16384,
+                 total_budget=256 * 1024):
+        super(SessionManager, self).__init__(parent)
+
+        self.session_budget = session_budget
+        self.total_budget = total_budget
+
+        # fd: session
+        self.sessions = {}
+        self.epoll = select.epoll()
+        self.notifier = QtCore.QSocketNotifier(self.epoll.fileno(),
+                                               QtCore.QSocketNotifier.Read,
+                                               self)
+        self.connect(self.notifier, QtCore.SIGNAL('activated(int)'),
+                     self.poll)
+
+        # totals over all the sessions
+        self.wakeups = 0
+        self.rounds = 0
+        self.bytes_read = 0
+        self.max_ready = 0
+
+    def add(self, session):
+        fd = session.stream.fileno()
+        self.sessions[fd] = session
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def remove(self, session):
+        fd = session.stream.fileno()
+        if self.sessions.pop(fd, None) is not None:
+            self.epoll.unregister(fd)
+
+    def pause(self, session):
+        """
+        Stops reading session until resume is called.
+        """
+        fd = session.stream.fileno()
+        if fd in self.sessions:
+            self.epoll.modify(fd, 0)
+
+    def resume(self, session):
+        fd = session.stream.fileno()
+        if fd in self.sessions:
+            self.epoll.modify(fd, select.EPOLLIN)
+
+    def poll(self, fd=None):
+        self.wakeups += 1
+        ready = [self.sessions[fd] for fd, mask in self.epoll.poll(0)
+                 if fd in self.sessions]
+        self.max_ready = max(self.max_ready, len(ready))
+
+        outputs = {}
+        closed = []
+        total = 0
+        while ready and total < self.total_budget:
+            self.rounds += 1
+            unfinished = []
+            for session in ready:
+                data, count, broken_pipe = session.drain(self.session_budget)
+                output = session.decode_input(data)
+                if output:
+                    outputs.setdefault(session, []).append(output)
+                total += count
+
+                if broken_pipe:
+                    closed.append(session)
+                elif count == self.session_budget:
+                    unfinished.append(session)
+            ready = unfinished
+        # what's left keeps the epoll fd readable, it's read on the next
+        # wakeup after the event loop had its turn
+        self.bytes_read += total
+
+        for session, chunks in outputs.iteritems():
+            session.wakeups += 1
+            session.emit(QtCore.SIGNAL("receive"), u"".join(chunks))
+            if session.read_interval and session not in closed:
+                self.pause(session)
+                QtCore.QTimer.singleShot(session.read_interval,
+                                         session.listen)
+
+        for session in closed:
+            self.remove(session)
+        if closed:
+            # the children are reaped now if they're gone, otherwise
+            # SIGCHLD will tell when they go
+            session_module.ChildWatcher.instance().reap()
+
+    def metrics(self):
+        """
+        Returns the aggregate counters of the sessions managed.
+        """
+        return {"sessions": len(self.sessions),
+                "wakeups": self.wakeups,
+                "rounds": self.rounds,
+                "bytes_read": self.bytes_read,
+                "max_ready": self.max_ready,
+                "bytes_per_wakeup": (float(self.bytes_read) / self.wakeups
+                                     if self.wakeups else 0.0)}
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+import codecs
+from errno import EAGAIN
+import io
+
+
+class PtyReader(object):
+    """
+    Reading and decoding of the output of a pty, for the sessions to mix
+    in. init_reader must be called once the pty is open and non blocking;
+    the owner calls drain when the pty is readable and decode_input on what
+    it returns.
+    """
+    def init_reader(self, fd, encoding="utf-8", errors="replace"):
+        # bytes asked for by every read, it grows while reads fill it and
+        # shrinks while they come back mostly empty
+        self.read_size = 4096
+        self.min_read_size = 1024
+        self.max_read_size = 65536
+        # most bytes read on a single wakeup before letting the event loop
+        # run again
+        self.read_budget = 256 * 1024
+
+        # bytes read from the child, no. of reads that returned data and
+        # no. of times the owner woke up to read
+        self.bytes_read = 0
+        self.reads = 0
+        self.wakeups = 0
+        self.max_wakeup_bytes = 0
+
+        # decodes the child output as it comes, see set_encoding
+        self.encoding = None
+        self.decoder = None
+        self.set_encoding(encoding, errors)
+
+        # the pty is read straight into this buffer, a wakeup never reads
+        # more than read_budget bytes, plus the incomplete sequence kept at
+        # the start from the previous one
+        self.child_io = io.FileIO(fd, "r", closefd=False)
+        self.buffer = bytearray(self.read_budget + 16)
+        self.buffer_view = memoryview(self.buffer)
+        self.buffer_kept = 0
+
+    def drain(self, budget):
+        """
+        Reads until the pty has nothing left (EAGAIN) or budget bytes were
+        read. Returns a memoryview of the bytes read, preceded by those kept
+        by the last decode_input call, the no. of bytes read and whether the
+        child side of the pty was closed. The view is only valid until the
+        next call.
+        """
+        start = end = self.buffer_kept
+        limit = min(start + budget, len(self.buffer))
+        broken_pipe = False
+        while end < limit:
+            size = min(self.read_size, limit - end)
+            try:
+                count = self.child_io.readinto(
+                    self.buffer_view[end:end + size])
+            except (IOError, OSError), err:
+                if err.errno != EAGAIN:
+                    # EIO, the child side of the pty was closed
+                    broken_pipe = True
+                break
+            if count is None:
+                # EAGAIN
+                break
+            if not count:
+                broken_pipe = True
+                break
+
+            end += count
+            self.reads += 1
+            if count == self.read_size:
+                self.read_size = min(self.read_size * 2, self.max_read_size)
+            elif count < self.read_size / 4:
+                self.read_size = max(self.read_size / 2, self.min_read_size)
+
+        total = end - start
+        self.bytes_read += total
+        if total > self.max_wakeup_bytes:
+            self.max_wakeup_bytes = total
+        return self.buffer_view[:end], total, broken_pipe
+
+    def set_encoding(self, encoding, errors="replace"):
+        """
+        Decodes the child output from encoding from now on, handling the
+        invalid bytes with the errors policy, any name codecs.lookup_error
+        knows ("strict" makes get_input raise UnicodeDecodeError).
+        """
+        codecs.lookup_error(errors)
+        self.encoding = encoding
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+        self.buffer_kept = 0
+
+    def set_decode_errors(self, errors):
+        """
+        Changes how invalid bytes are decoded, see set_encoding.
+        """
+        codecs.lookup_error(errors)
+        self.decoder.errors = errors
+
+    def decode_input(self, data):
+        """
+        Decodes a view returned by drain, keeping an incomplete trailing
+        sequence at the start of the buffer for the next call. It only
+        looks at the bytes of data once, however they are split.
+        """
+        # buffered decoders (utf-8 and most others) can work on the view,
+        # their incomplete tail is kept in our buffer instead of theirs
+        decode = getattr(self.decoder, "_buffer_decode", None)
+        if decode is None:
+            self.buffer_kept = 0
+            return self.decoder.decode(data.tobytes())
+
+        chars, decodedbytes = decode(data, self.decoder.errors, False)
+        tail = data[decodedbytes:].tobytes()
+        self.buffer[:len(tail)] = tail
+        self.buffer_kept = len(tail)
+        return chars
+
+    def bytes_per_wakeup(self):
+        if not self.wakeups:
+            return 0.0
+        return float(self.bytes_read) / self.wakeups
@@ -0,0 +1,303 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Re-encodes terminal frames as VT escape sequences, for mirroring a screen
+to a viewer without the raw child output.
+
+A FrameEncoder remembers the last TerminalSnapshot it encoded and what it
+left the viewer with (cursor, SGR). encode() returns the sequence turning
+that frame into the next one: only changed cells are written, the cursor
+takes the shortest of CUP, relative motions, CR/LF, backspaces and
+rewriting cells that are already right, trailing blanks are erased with
+EL, renditions change with SGR deltas, and scrolls are sent as line feeds
+at the bottom row. A slow viewer just skips frames, the next encode()
+diffs against the last frame it was sent.
+"""
+import emuvt100
+
+DEFAULT_KEY = emuvt100.Rendition().key()
+
+# key() fields
+BLINKING, ITALIC, UNDERLINE, BG_COLOR, FG_COLOR, FONT, INTENSITY = range(7)
+
+
+def rendition_key(rendition):
+    if rendition is None:
+        return DEFAULT_KEY
+    return rendition.key()
+
+
+def _reversed(key):
+    # V102Terminal can't set foreground color 0, 30 means the default, so
+    # these come from SGR 7 swapping the colors
+    return key[FG_COLOR] == 0 and key[BG_COLOR] != 0
+
+
+def _intensity(value):
+    if value > 0:
+        return ["1"] * value
+    return ["2"] * -value
+
+
+def sgr(key, old=None):
+    """
+    Returns the SGR sequence setting the rendition key, as a delta from the
+    old key when that's shorter.
+    """
+    params = ["0"] + _intensity(key[INTENSITY])
+    for field, on in ((ITALIC, "3"), (UNDERLINE, "4"), (BLINKING, "5")):
+        if key[field]:
+            params.append(on)
+    if key[FONT]:
+        params.append("1%d" % key[FONT])
+    if _reversed(key):
+        if key[BG_COLOR] != 7:
+            params.append("3%d" % key[BG_COLOR])
+        params.append("7")
+    else:
+        if key[FG_COLOR] != 7:
+            params.append("3%d" % key[FG_COLOR])
+        if key[BG_COLOR] != 0:
+            params.append("4%d" % key[BG_COLOR])
+    full = u"\033[%sm" % ";".join(params)
+    if old is None or _reversed(key) or _reversed(old):
+        return full
+
+    params = []
+    if key[INTENSITY] != old[INTENSITY]:
+        if old[INTENSITY]:
+            params.append("22")
+        params.extend(_intensity(key[INTENSITY]))
+    for field, on, off in ((ITALIC, "3", "23"), (UNDERLINE, "4", "24"),
+                           (BLINKING, "5", "25")):
+        if key[field] != old[field]:
+            params.append(on if key[field] else off)
+    if key[FONT] != old[FONT]:
+        params.append("1%d" % key[FONT])
+    if key[FG_COLOR] != old[FG_COLOR]:
+        params.append("39" if key[FG_COLOR] == 7 else
+                      "3%d" % key[FG_COLOR])
+    if key[BG_COLOR] != old[BG_COLOR]:
+        params.append("49" if key[BG_COLOR] == 0 else
+                      "4%d" % key[BG_COLOR])
+    delta = u"\033[%sm" % ";".join(params)
+    if len(delta) < len(full):
+        return delta
+    return full
+
+
+class FrameEncoder(object):
+    """
+    Turns successive TerminalSnapshots into the VT sequences updating a
+    viewer from one to the next.
+    """
+    def __init__(self):
+        self.frame = None
+        # what the viewer was left with, None when not known
+        self.row = None
+        self.col = None
+        self.key = None
+
+        # characters and cells written, for measuring
+        self.bytes_encoded = 0
+        self.cells_written = 0
+
+    def reset(self):
+        """
+        Makes the next frame a full repaint, e.g. for a new viewer.
+        """
+        self.frame = None
+
+    def encode(self, frame):
+        out = []
+        rows, cols = frame.GetSize()
+        if self.frame is None or self.frame.GetSize() != (rows, cols):
+            out.append(u"\033[0m\033[H\033[2J")
+            self.row, self.col, self.key = 0, 0, DEFAULT_KEY
+            blank = ([u" "] * cols, [None] * cols)
+            base = [blank] * rows
+        else:
+            base = self._scroll(out, frame)
+
+        for row in xrange(rows):
+            old_chars, old_rends = base[row]
+            self._encode_line(out, row, old_chars, old_rends,
+                              frame.screen[row], frame.scrRendition[row])
+
+        row, col = frame.GetCursorPos()
+        col = min(col, cols - 1)
+        self._move(out, row, col, frame.screen[row],
+                   frame.scrRendition[row])
+
+        self.frame = frame
+        data = u"".join(out)
+        self.bytes_encoded += len(data)
+        return data
+
+    def _scroll(self, out, frame):
+        """
+        Scrolls the viewer if the frame has the lines of the previous one
+        further up, returns the lines the viewer has then.
+        """
+        old = self.frame
+        rows, cols = frame.GetSize()
+        # unchanged lines are the same lists in both snapshots
+        index = dict((id(line), row) for row, line in enumerate(old.screen))
+        base = zip(old.screen, old.scrRendition)
+
+        shift = 0
+        for row, line in enumerate(frame.screen):
+            old_row = index.get(id(line))
+            if old_row is not None:
+                shift = old_row - row
+                break
+        if shift <= 0:
+            return base
+
+        kept = sum(1 for row in xrange(rows - shift)
+                   if frame.screen[row] is old.screen[row + shift])
+        unshifted = sum(1 for row in xrange(rows)
+                        if frame.screen[row] is old.screen[row])
+        if kept <= unshifted:
+            return base
+
+        # new lines are blank with the background of the SGR in effect
+        if self.key is None or self.key[BG_COLOR] != 0:
+            self._set_key(out, DEFAULT_KEY)
+        self._move(out, rows - 1, 0, None, None)
+        out.append(u"\n" * shift)
+        blank = ([u" "] * cols, [None] * cols)
+        return base[shift:] + [blank] * shift
+
+    def _encode_line(self, out, row, old_chars, old_rends, chars, rends):
+        if chars is old_chars and rends is old_rends:
+            return
+        cols = len(chars)
+        changed = [col for col in xrange(cols)
+                   if chars[col] != old_chars[col] or
+                   (rends[col] is not old_rends[col] and
+                    rendition_key(rends[col]) !=
+                    rendition_key(old_rends[col]))]
+        if not changed:
+            return
+
+        # trailing blanks changed over a long enough stretch are erased
+        tail = cols
+        while (tail > 0 and chars[tail - 1] == u" " and
+               rendition_key(rends[tail - 1]) == DEFAULT_KEY):
+            tail -= 1
+        erase_from = None
+        erased = [col for col in changed if col >= tail]
+        if erased and erased[-1] - erased[0] + 1 > len(u"\033[K"):
+            erase_from = erased[0]
+            changed = changed[:len(changed) - len(erased)]
+
+        i = 0
+        while i < len(changed):
+            start = changed[i]
+            end = i + 1
+            while end < len(changed) and changed[end] == start + end - i:
+                end += 1
+            self._move(out, row, start, chars, rends)
+            self._write(out, chars, rends, start, start + end - i)
+            i = end
+
+        if erase_from is not None:
+            self._move(out, row, erase_from, chars, rends)
+            self._set_key(out, DEFAULT_KEY)
+            out.append(u"\033[K")
+
+    def _write(self, out, chars, rends, start, end):
+        for col in xrange(start, end):
+            key = rendition_key(rends[col])
+            if key != self.key:
+                self._set_key(out, key)
+            out.append(chars[col])
+        self.cells_written += end - start
+        # past the last column the viewer is about to wrap, CR and CUP are
+        # the only safe ways out of there
+        self.col = end if end < len(chars) else None
+
+    def _set_key(self, out, key):
+        out.append(sgr(key, self.key))
+        self.key = key
+
+    def _move(self, out, row, col, chars, rends):
+        if self.row == row and self.col == col:
+            return
+        if (row, col) == (0, 0):
+            best = u"\033[H"
+        else:
+            best = u"\033[%d;%dH" % (row + 1, col + 1)
+
+        if self.row is not None:
+            down = row - self.row
+            if self.col is not None:
+                vertical = u""
+                if down:
+                    count = u"%d" % abs(down) if abs(down) > 1 else u""
+                    vertical = u"\033[%s%s" % (count,
+                                               "B" if down > 0 else "A")
+                for motion in (
+                        self._horizontal(self.col, col, chars, rends),
+                        u"\033[%dG" % (col + 1)):
+                    if len(vertical + motion) < len(best):
+                        best = vertical + motion
+            if down >= 0:
+                motion = (u"\r" + u"\n" * down +
+                          self._horizontal(0, col, chars, rends))
+                if len(motion) < len(best):
+                    best = motion
+
+        out.append(best)
+        self.row, self.col = row, col
+
+    def _horizontal(self, start, col, chars, rends):
+        if col == start:
+            return u""
+        if col < start:
+            back = u"\b" * (start - col)
+            left = u"\033[%dD" % (start - col)
+            return back if len(back) <= len(left) else left
+
+        right = u"\033[C" if col - start == 1 else \
+            u"\033[%dC" % (col - start)
+        # the cells in between are right already, writing them again with
+        # the same SGR is shorter than a CUF for small gaps
+        if (chars is not None and col - start < len(right) and
+                all(rendition_key(rends[i]) == self.key
+                    for i in xrange(start, col))):
+            return u"".join(chars[start:col])
+        return right
+
+
+def encode(old, new):
+    """
+    Returns the VT sequences turning a viewer showing the old snapshot,
+    with its cursor where the old one had it, into the new snapshot. old
+    can be None, for a full repaint.
+    """
+    encoder = FrameEncoder()
+    if old is not None:
+        encoder.frame = old
+        encoder.row, encoder.col = old.GetCursorPos()
+        if encoder.col >= old.GetSize()[1]:
+            encoder.col = None
+    return encoder.encode(new)
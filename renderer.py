@@ -0,0 +1,297 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+import time
+from PyQt4 import QtGui, QtCore
+
+# NORMAL, LIGHT/BRIGHT
+COLOR_TABLE = [#black
+               (QtGui.QColor(0, 0, 0), QtGui.QColor(0, 0, 0)),
+               #red
+               (QtGui.QColor(205, 0, 0), QtGui.QColor(205, 0, 0)),
+               #green
+               (QtGui.QColor(0, 205, 0), QtGui.QColor(205, 0, 0)),
+               #brown,yellow
+               (QtGui.QColor(205, 205, 0), QtGui.QColor(205, 0, 0)),
+               #blue
+               (QtGui.QColor(0, 0, 238), QtGui.QColor(205, 0, 0)),
+               #magenta
+               (QtGui.QColor(205, 0, 205), QtGui.QColor(205, 0, 0)),
+               #cyan
+               (QtGui.QColor(0, 205, 205), QtGui.QColor(205, 0, 0)),
+               #gray
+               (QtGui.QColor(229, 229, 229), QtGui.QColor(205, 0, 0))]
+
+
+class Frame(object):
+    """
+    Snapshot of what changed on the screen since the previous frame. It
+    holds copies of the damaged cells, so it can be drawn from another
+    thread while the emulator keeps changing.
+
+    segments is a sequence of (row, first_col, chars, renditions) tuples,
+    drawn in order after scrolling the image up scroll lines and fitting it
+    to size. A full frame starts from a blank image instead.
+    """
+    def __init__(self, size, font, cell_width, cell_height, blink,
+                 full=False, scroll=0, segments=()):
+        self.size = QtCore.QSize(size)
+        self.font = QtGui.QFont(font)
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.blink = blink
+        self.full = full
+        self.scroll = scroll
+        self.segments = tuple(segments)
+
+    def merged(self, newer):
+        """
+        Returns a frame with the damage of this frame followed by the damage
+        of newer, for when this one is replaced before being drawn.
+        """
+        if newer.full:
+            return newer
+
+        # our rows move with the lines newer scrolled
+        segments = [(row - newer.scroll, first_col, chars, renditions)
+                    for row, first_col, chars, renditions in self.segments
+                    if row >= newer.scroll]
+        segments.extend(newer.segments)
+
+        if self.full:
+            scroll = 0
+        else:
+            scroll = self.scroll + newer.scroll
+
+        return Frame(newer.size, newer.font, newer.cell_width,
+                     newer.cell_height, newer.blink, self.full, scroll,
+                     segments)
+
+    def cells(self):
+        """
+        Returns the no. of cells drawn by the frame.
+        """
+        return sum(len(chars) for row, first_col, chars, renditions
+                   in self.segments)
+
+
+class Rasterizer(object):
+    """
+    Draws cells and frames into a QImage. It only uses QPainter on images,
+    so it may run outside the GUI thread.
+    """
+    def __init__(self, background_color):
+        self.image = QtGui.QImage()
+        self.background_color = QtGui.QColor(background_color)
+
+        self.font = QtGui.QFont()
+        self.cell_width = 1
+        self.cell_height = 1
+        self.blink = True
+
+        self.cells_drawn = 0
+
+        # rasterize() adds the seconds it takes to render_time while timing
+        # is set
+        self.timing = False
+        self.render_time = 0.0
+
+    def configure(self, font, cell_width, cell_height, blink):
+        self.font = font
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.blink = blink
+
+    def rasterize(self, frame):
+        """
+        Draws frame into the image and returns the list of rectangles of the
+        image it changed.
+        """
+        if self.timing:
+            start = time.time()
+
+        self.configure(frame.font, frame.cell_width, frame.cell_height,
+                       frame.blink)
+        rects = []
+
+        if frame.full or self.image.isNull():
+            self.image = QtGui.QImage(frame.size, QtGui.QImage.Format_RGB32)
+            self.image.fill(self.background_color.rgb())
+            rects.append(self.image.rect())
+        else:
+            # scrolled lines are in the coordinates of the old size, the
+            # emulator drops lines from the top when it shrinks
+            if frame.scroll:
+                self._scroll(frame.scroll)
+                rects.append(self.image.rect())
+            if self.image.size() != frame.size:
+                self._resize(frame.size)
+                rects.append(self.image.rect())
+
+        painter = QtGui.QPainter(self.image)
+        for row, first_col, chars, renditions in frame.segments:
+            for i, char in enumerate(chars):
+                self.draw_char(painter, row, first_col + i, renditions[i],
+                               char)
+            rects.append(QtCore.QRect(first_col * self.cell_width,
+                                      row * self.cell_height,
+                                      len(chars) * self.cell_width,
+                                      self.cell_height))
+            self.cells_drawn += len(chars)
+        painter.end()
+
+        if self.timing:
+            self.render_time += time.time() - start
+        return rects
+
+    def _scroll(self, lines):
+        # shift what is already drawn and only clear the exposed bottom rows
+        rect = self.image.rect()
+        height = lines * self.cell_height
+
+        painter = QtGui.QPainter(self.image)
+        if height < rect.height():
+            moved = self.image.copy(0, height, rect.width(),
+                                    rect.height() - height)
+            painter.drawImage(0, 0, moved)
+        bottom = max(0, rect.height() - height)
+        painter.fillRect(QtCore.QRect(0, bottom, rect.width(),
+                                      rect.height() - bottom),
+                         self.background_color)
+        painter.end()
+
+    def _resize(self, size):
+        # keeps what is drawn, anchored at the top left corner
+        image = QtGui.QImage(size, QtGui.QImage.Format_RGB32)
+        image.fill(self.background_color.rgb())
+        painter = QtGui.QPainter(image)
+        painter.drawImage(0, 0, self.image)
+        painter.end()
+        self.image = image
+
+    def _get_rendition_font(self, rendition):
+        font = QtGui.QFont(self.font)
+        if rendition.intensity > 0:
+            font.setBold(True)
+        elif rendition.intensity < 0:
+            font.setWeight(font.Light)
+        if rendition.italic:
+            font.setItalic(True)
+        if rendition.underline:
+            font.setUnderline(True)
+        return font
+
+    def _get_color_from_table(self, color_index):
+        return COLOR_TABLE[color_index][0]
+
+    def draw_char(self, painter, row, col, rendition, char):
+        x = col * self.cell_width
+        y = row * self.cell_height
+
+        if rendition:
+            font = self._get_rendition_font(rendition)
+            bg_color = self._get_color_from_table(rendition.bg_color)
+            if rendition.blinking and not self.blink:
+                fg_color = bg_color
+            else:
+                fg_color = self._get_color_from_table(rendition.fg_color)
+        else:
+            font = self.font
+            fg_color = self.background_color
+            bg_color = self.background_color
+
+        rect = QtCore.QRect(QtCore.QPoint(x, y),
+                            QtCore.QSize(self.cell_width,
+                                         self.cell_height))
+        painter.fillRect(rect, bg_color)
+        painter.setFont(font)
+        painter.setPen(fg_color)
+        painter.drawText(rect, QtCore.Qt.AlignCenter, char)
+
+
+class RenderWorker(QtCore.QThread):
+    """
+    Rasterizes frames in its own thread. A frame submitted while another is
+    still waiting replaces it, their damage merged, so the worker always
+    draws the newest state. The "rendered" signal carries the rectangles of
+    image() changed by each frame.
+    """
+    def __init__(self, background_color, parent=None):
+        super(RenderWorker, self).__init__(parent)
+
+        self.rasterizer = Rasterizer(background_color)
+
+        self.mutex = QtCore.QMutex()
+        self.condition = QtCore.QWaitCondition()
+        self.pending = None
+        self.front = QtGui.QImage()
+        self.running = True
+
+        self.frames = 0
+        self.dropped = 0
+
+    def submit(self, frame):
+        self.mutex.lock()
+        try:
+            if self.pending is not None:
+                frame = self.pending.merged(frame)
+                self.dropped += 1
+            self.pending = frame
+            self.condition.wakeOne()
+        finally:
+            self.mutex.unlock()
+
+    def image(self):
+        """
+        Returns the last finished image.
+        """
+        self.mutex.lock()
+        try:
+            return self.front
+        finally:
+            self.mutex.unlock()
+
+    def stop(self):
+        self.mutex.lock()
+        self.running = False
+        self.condition.wakeOne()
+        self.mutex.unlock()
+        self.wait()
+
+    def run(self):
+        while True:
+            self.mutex.lock()
+            while self.pending is None and self.running:
+                self.condition.wait(self.mutex)
+            if not self.running:
+                self.mutex.unlock()
+                return
+            frame, self.pending = self.pending, None
+            self.mutex.unlock()
+
+            rects = self.rasterizer.rasterize(frame)
+
+            # shallow copy, the rasterizer detaches from it the next time it
+            # paints so the GUI thread never sees a half drawn image
+            self.mutex.lock()
+            self.front = QtGui.QImage(self.rasterizer.image)
+            self.mutex.unlock()
+
+            self.frames += 1
+            self.emit(QtCore.SIGNAL("rendered"), rects)
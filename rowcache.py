@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+
+
+class RowImageCache(object):
+    """
+    Least recently used cache of rendered rows. Keys describe the content of
+    a row (text, attributes, width and font) so equal rows share an image no
+    matter where they are in the history. The least recently used images are
+    evicted once their total size goes over budget bytes.
+    """
+    def __init__(self, budget=8 * 1024 * 1024):
+        self.budget = budget
+        self.size = 0
+        self.images = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the image cached for key, or None.
+        """
+        item = self.images.pop(key, None)
+        if item is None:
+            self.misses += 1
+            return None
+
+        # reinserting makes it the most recently used
+        self.images[key] = item
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, image, cost):
+        """
+        Caches image for key, cost being its size in bytes.
+        """
+        if cost > self.budget:
+            return
+
+        item = self.images.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+        self.images[key] = (image, cost)
+        self.size += cost
+        self._evict()
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self._evict()
+
+    def clear(self):
+        self.images.clear()
+        self.size = 0
+
+    def hit_rate(self):
+        """
+        Returns the fraction of lookups found in the cache.
+        """
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def _evict(self):
+        while self.size > self.budget:
+            key, (image, cost) = self.images.popitem(last=False)
+            self.size -= cost
+
+    def __len__(self):
+        return len(self.images)
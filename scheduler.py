@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+import time
+from PyQt4 import QtCore
+
+
+class FrameScheduler(QtCore.QObject):
+    """
+    Coalesces render requests into frames. Input keeps being parsed as it
+    arrives, but the render callback runs at most once per frame interval.
+    A request arriving after the screen has been idle for a whole interval
+    is rendered right away, so typing doesn't wait for the timer.
+
+    The interval grows with the measured render cost, so that rendering
+    never takes more than render_share of the time and a flood of output
+    still leaves room to read input and handle key presses.
+    """
+    def __init__(self, render, parent=None, min_interval=16,
+                 max_interval=200, render_share=0.5):
+        super(FrameScheduler, self).__init__(parent)
+
+        self.render = render
+
+        # milliseconds
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.render_share = render_share
+
+        # exponential moving average of the render cost, in milliseconds
+        self.render_cost = 0.0
+        self.last_frame = 0.0
+
+        self.frames = 0
+        self.coalesced = 0
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.connect(self.timer, QtCore.SIGNAL("timeout()"), self.frame)
+
+    def schedule(self):
+        """
+        Requests a frame. Requests made while a frame is already pending are
+        folded into it.
+        """
+        if self.timer.isActive():
+            self.coalesced += 1
+            return
+
+        elapsed = (time.time() - self.last_frame) * 1000
+        if elapsed >= self.interval:
+            self.frame()
+        else:
+            self.timer.start(int(self.interval - elapsed))
+
+    def cancel(self):
+        """
+        Drops the pending request, if any.
+        """
+        self.timer.stop()
+
+    def frame(self):
+        """
+        Renders now, dropping any pending request.
+        """
+        self.timer.stop()
+
+        start = time.time()
+        self.render()
+        self.last_frame = time.time()
+
+        cost = (self.last_frame - start) * 1000
+        self.render_cost += (cost - self.render_cost) * 0.25
+        self.interval = min(self.max_interval,
+                            max(self.min_interval,
+                                self.render_cost / self.render_share))
+        self.frames += 1
@@ -17,57 +17,240 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
-import codecs
-from errno import EAGAIN
+from errno import EAGAIN, EINTR
 import os
 from PyQt4 import QtCore
-import time
+import Queue
 import fcntl
+import select
+import signal
+import socket
+import time
+import daemon
+import emuprocess
 import ptty
+import ptyreader
+import writequeue
 
-class Session(QtCore.QThread):
-    def __init__(self, parent, cmd_path):
+# ms a remote session waits for the daemon to take its output on closing
+CLOSE_TIMEOUT = 5000
+
+
+class ChildWatcher(QtCore.QObject):
+    """
+    Notices when children exit without a thread or a timer per child. The
+    SIGCHLD handler wakes the event loop up through a self-pipe, see
+    signal.set_wakeup_fd, and only then are the watched children reaped
+    with a non blocking waitpid. Python 2 has no os.pidfd_open, which would
+    spare the signal handler.
+
+    There's one watcher per process, get it with instance(). It must be
+    created in the main thread and before spawning the children it
+    watches, or their SIGCHLD could be missed.
+    """
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        super(ChildWatcher, self).__init__()
+
+        # pid: (spawn, callback)
+        self.children = {}
+
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+        signal.set_wakeup_fd(self.write_fd)
+        signal.signal(signal.SIGCHLD, self._on_sigchld)
+        # don't make the reads and writes of the ptys fail with EINTR
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+        self.notifier = QtCore.QSocketNotifier(self.read_fd,
+                                               QtCore.QSocketNotifier.Read,
+                                               self)
+        self.connect(self.notifier, QtCore.SIGNAL('activated(int)'),
+                     self.reap)
+
+    def _on_sigchld(self, signum, frame):
+        # the byte written to the wakeup fd is all it takes
+        pass
+
+    def watch(self, child, callback):
+        """
+        Calls callback once the spawned child exits.
+        """
+        self.children[child.pid] = (child, callback)
+
+    def unwatch(self, child):
+        self.children.pop(child.pid, None)
+
+    def reap(self, fd=None):
+        try:
+            while os.read(self.read_fd, 512):
+                pass
+        except OSError, err:
+            if err.errno != EAGAIN:
+                raise
+
+        for pid, (child, callback) in self.children.items():
+            if not child.isalive():
+                del self.children[pid]
+                callback()
+
+
+class ReaderThread(QtCore.QThread):
+    """
+    Reads and decodes the output of a session in its own thread, so the
+    child isn't kept waiting while the GUI is busy. Decoded chunks are
+    handed over through a bounded queue: when the GUI falls behind the
+    thread blocks on the full queue and stops reading, and then the child
+    blocks on the full pty. "ready" is emitted when a chunk is queued into
+    an empty queue, the GUI then takes everything queued.
+    """
+    def __init__(self, session, queue_size=64):
+        super(ReaderThread, self).__init__()
+
+        self.session = session
+        self.queue = Queue.Queue(queue_size)
+        self.running = True
+        self.finishing = False
+
+        # deepest the queue has been and seconds spent waiting for room in
+        # it
+        self.max_depth = 0
+        self.blocked_time = 0.0
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def finish(self):
+        """
+        Makes the thread end once the pty has nothing left to read.
+        """
+        self.finishing = True
+
+    def stop(self):
+        self.running = False
+        self.wait()
+
+    def run(self):
+        session = self.session
+        fd = session.stream.fileno()
+        while self.running:
+            try:
+                readable = select.select([fd], [], [], 0.1)[0]
+            except select.error, err:
+                if err[0] == EINTR:
+                    continue
+                raise
+            if not readable and not self.finishing:
+                continue
+
+            session.wakeups += 1
+            data, count, broken_pipe = session.drain(session.read_budget)
+            output = session.decode_input(data)
+            if output:
+                self.put(output)
+            if broken_pipe or (self.finishing and not count):
+                break
+
+            if session.read_interval:
+                self.msleep(session.read_interval)
+
+    def put(self, output):
+        try:
+            self.queue.put_nowait(output)
+        except Queue.Full:
+            start = time.time()
+            while self.running:
+                try:
+                    self.queue.put(output, True, 0.1)
+                    break
+                except Queue.Full:
+                    pass
+            self.blocked_time += time.time() - start
+
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if depth == 1:
+            self.emit(QtCore.SIGNAL("ready"))
+
+
+class Session(QtCore.QObject, ptyreader.PtyReader):
+    def __init__(self, parent, cmd_path, encoding="utf-8", errors="replace",
+                 threaded=False, queue_size=64, manager=None):
         super(Session, self).__init__()
 
         self._parent = parent
         self.connect(parent, QtCore.SIGNAL("write"), self.write)
         self.connect(parent, QtCore.SIGNAL("resize"), self.resize)
         self.connect(parent, QtCore.SIGNAL("close_pty"), self.close_pty)
+        self.connect(parent, QtCore.SIGNAL("paste"), self.paste)
 
-        self.buffer_size = 16384
+        # milliseconds to wait after a read before reading again, the child
+        # blocks once the pty buffer fills up in the meantime
+        self.read_interval = 0
 
         self.cmd_path = cmd_path
+        watcher = ChildWatcher.instance()
         self.stream = ptty.spawn(cmd_path)
 
         # Set child descriptor non blocking
         fl = fcntl.fcntl(self.stream.fileno(), fcntl.F_GETFL)
         fcntl.fcntl(self.stream.fileno(), fcntl.F_SETFL, fl | os.O_NONBLOCK )
 
-        self.linebuffer = u""
-        self.charbuffer = u""
-        self.bytebuffer = ""
+        self.init_reader(self.stream.fileno(), encoding, errors)
 
         #self.stream.setecho(False)
         self.notifier = QtCore.QSocketNotifier(self.stream.fileno(),
                                                QtCore.QSocketNotifier.Read)
-        self.utf8_child = codecs.getreader('utf8')(self.stream)
-        self._parent.app.connect(self.notifier,
-                                 QtCore.SIGNAL('activated(int)'),
-                                 self.get_input)
+        self.connect(self.notifier, QtCore.SIGNAL('activated(int)'),
+                     self.get_input)
 
-    def get_input(self, fd):
-        self._parent.app.disconnect(self.notifier,
-                                    QtCore.SIGNAL('activated(int)'),
-                                    self.get_input)
-        output = u""
-        broken_pipe = False
+        # input the pty didn't take yet, written as soon as it's writable
+        self.write_queue = writequeue.WriteQueue(self.stream.fileno(),
+                                                 encoding)
+        self.write_notifier = QtCore.QSocketNotifier(
+            self.stream.fileno(), QtCore.QSocketNotifier.Write)
+        self.write_notifier.setEnabled(False)
+        self.connect(self.write_notifier, QtCore.SIGNAL('activated(int)'),
+                     self._write_ready)
 
-        try:
-            output = self.read(self.buffer_size)
-        except OSError:
-            broken_pipe = True
+        # a child exiting right away is reaped once the event loop runs
+        self.exited = False
+        self.done = False
+        watcher.watch(self.stream, self._child_exited)
 
-        #broken_pipe = True
+        # reads in a ReaderThread, or along with other sessions in a
+        # SessionManager, instead of on the notifier wakeups
+        self.reader = None
+        self.manager = None
+        if threaded:
+            self.notifier.setEnabled(False)
+            self.reader = ReaderThread(self, queue_size)
+            self.connect(self.reader, QtCore.SIGNAL("ready"), self.dequeue)
+            self.connect(self.reader, QtCore.SIGNAL("finished()"),
+                         self._reader_finished)
+            self.reader.start()
+        elif manager is not None:
+            self.notifier.setEnabled(False)
+            self.manager = manager
+            self.manager.add(self)
+
+    def get_input(self, fd):
+        self.notifier.setEnabled(False)
+        self.wakeups += 1
+
+        data, count, broken_pipe = self.drain(self.read_budget)
+        output = self.decode_input(data)
 
         if not broken_pipe:
             #my_output = output
@@ -79,118 +262,385 @@ class Session(QtCore.QThread):
             #f.close()
             #print "Output: %s" % output
 
-            self.emit(QtCore.SIGNAL("receive"), output)
-            self._parent.app.connect(self.notifier,
-                                     QtCore.SIGNAL('activated(int)'),
-                                     self.get_input)
+            if output:
+                self.emit(QtCore.SIGNAL("receive"), output)
+            if self.read_interval:
+                QtCore.QTimer.singleShot(self.read_interval, self.listen)
+            else:
+                self.listen()
         else:
-            pass
-            #print "Broken Pipe"
-
-    def read(self, size=-1, chars=-1, firstline=False):
-        """ Decodes data from the stream self.stream and returns the
-            resulting object.
-
-            chars indicates the number of characters to read from the
-            stream. read() will never return more than chars
-            characters, but it might return less, if there are not enough
-            characters available.
-
-            size indicates the approximate maximum number of bytes to
-            read from the stream for decoding purposes. The decoder
-            can modify this setting as appropriate. The default value
-            -1 indicates to read and decode as much as possible.  size
-            is intended to prevent having to decode huge files in one
-            step.
-
-            If firstline is true, and a UnicodeDecodeError happens
-            after the first line terminator in the input only the first line
-            will be returned, the rest of the input will be kept until the
-            next call to read().
-
-            The method should use a greedy read strategy meaning that
-            it should read as much data as is allowed within the
-            definition of the encoding and the given size, e.g.  if
-            optional encoding endings or state markers are available
-            on the stream, these should be read too.
-        """
-        # If we have lines cached, first merge them back into characters
-        if self.linebuffer:
-            self.charbuffer = u"".join(self.linebuffer)
-            self.linebuffer = None
+            if output:
+                self.emit(QtCore.SIGNAL("receive"), output)
+            # the child is reaped now if it's gone, otherwise SIGCHLD will
+            # tell when it goes
+            ChildWatcher.instance().reap()
 
-        # read until we get the required number of characters (if available)
+    def dequeue(self):
+        """
+        Passes on everything the ReaderThread has queued so far.
+        """
+        chunks = []
         while True:
-            # can the request can be satisfied from the character buffer?
-            if chars < 0:
-                if size < 0:
-                    if self.charbuffer:
-                        break
-                elif len(self.charbuffer) >= size:
-                    break
-            else:
-                if len(self.charbuffer) >= chars:
-                    break
-            # we need more data
             try:
-                if size < 0:
-                    newdata = self.stream.read()
-                else:
-                    newdata = self.stream.read(size)
-            except OSError, err:
-                if err.errno == EAGAIN:
+                chunks.append(self.reader.queue.get_nowait())
+            except Queue.Empty:
+                break
+        if chunks:
+            self.emit(QtCore.SIGNAL("receive"), u"".join(chunks))
+
+    def _reader_finished(self):
+        self.dequeue()
+        if self.exited:
+            self._done()
+        else:
+            # the pty was closed, the child is probably gone
+            ChildWatcher.instance().reap()
+
+    def _child_exited(self):
+        self.exited = True
+        self.notifier.setEnabled(False)
+        if self.manager is not None:
+            self.manager.remove(self)
+        self.write_notifier.setEnabled(False)
+        self.write_queue.clear()
+
+        if self.reader is not None and self.reader.isRunning():
+            # it reads what the child wrote right before exiting and then
+            # ends, _reader_finished takes it from there
+            self.reader.finish()
+            return
+
+        if self.reader is None:
+            # what the child wrote right before exiting is still in the pty
+            while True:
+                data, count, broken_pipe = self.drain(self.read_budget)
+                output = self.decode_input(data)
+                if output:
+                    self.emit(QtCore.SIGNAL("receive"), output)
+                if broken_pipe or count < self.read_budget:
                     break
-                else:
-                    raise err
 
-            # decode bytes (those remaining from the last call included)
-            data = self.bytebuffer + newdata
+        self._done()
+
+    def _done(self):
+        if self.reader is not None:
+            self.dequeue()
+        if not self.done:
+            self.done = True
+            self.emit(QtCore.SIGNAL("done"))
+
+    def listen(self):
+        if self.exited:
+            return
+        if self.manager is not None:
+            self.manager.resume(self)
+        elif self.reader is None:
+            self.notifier.setEnabled(True)
+
+    def set_read_interval(self, interval):
+        """
+        Throttles reading the child output to once every interval
+        milliseconds, 0 reads it as soon as it's available.
+        """
+        self.read_interval = interval
+
+    def write(self, text):
+        self.write_queue.put(text)
+        self.write_notifier.setEnabled(self.write_queue.wants_write())
+
+    def paste(self, text, bracketed=False):
+        self.write_queue.paste(text, bracketed)
+        self.write_notifier.setEnabled(self.write_queue.wants_write())
+
+    def _write_ready(self, fd):
+        self.write_queue.flush()
+        self.write_notifier.setEnabled(self.write_queue.wants_write())
+
+    def resize(self, rows, cols):
+        self.stream.setwinsize(rows, cols)
+
+    def close_pty(self):
+        ChildWatcher.instance().unwatch(self.stream)
+        if self.reader is not None:
+            self.reader.stop()
+        if self.manager is not None:
+            self.manager.remove(self)
+        self.stream.terminate(True)
+
+
+class RemoteSession(QtCore.QObject):
+    """
+    A session run by a daemon.SessionDaemon. The snapshot and damage it
+    sends are applied to the terminal of the widget, which then only
+    renders them. Closing the widget detaches, the session keeps running
+    in the daemon.
+    """
+    def __init__(self, parent, socket_path, name, cmd_path):
+        super(RemoteSession, self).__init__()
+
+        self._parent = parent
+        self.connect(parent, QtCore.SIGNAL("write"), self.write)
+        self.connect(parent, QtCore.SIGNAL("resize"), self.resize)
+        self.connect(parent, QtCore.SIGNAL("close_pty"), self.close_pty)
+        self.connect(parent, QtCore.SIGNAL("paste"), self.paste)
+
+        self.replica = daemon.TerminalReplica(parent.terminal)
+        self.buffer = daemon.MessageBuffer()
+        self.output = ""
+        self.bytes_read = 0
+        self.read_interval = 0
+        self.done = False
+        # detaching, the socket is closed once the output is sent
+        self.closing = False
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.sock.setblocking(False)
+
+        self.notifier = QtCore.QSocketNotifier(self.sock.fileno(),
+                                               QtCore.QSocketNotifier.Read)
+        self.connect(self.notifier, QtCore.SIGNAL('activated(int)'),
+                     self.get_input)
+        self.write_notifier = QtCore.QSocketNotifier(
+            self.sock.fileno(), QtCore.QSocketNotifier.Write)
+        self.write_notifier.setEnabled(False)
+        self.connect(self.write_notifier, QtCore.SIGNAL('activated(int)'),
+                     self._write_ready)
+
+        rows, cols = parent.terminal.GetSize()
+        self.send({"op": "attach", "name": name, "cmd": cmd_path,
+                   "rows": rows, "cols": cols})
+
+    def get_input(self, fd):
+        self.notifier.setEnabled(False)
+
+        messages = []
+        closed = False
+        while True:
             try:
-                newchars, decodedbytes = self.decode(data)
-            except UnicodeDecodeError, exc:
-                if firstline:
-                    newchars, decodedbytes = self.decode(data[:exc.start])
-                    lines = newchars.splitlines(True)
-                    if len(lines)<=1:
-                        raise
-                else:
-                    raise
-            # keep undecoded bytes until the next call
-            self.bytebuffer = data[decodedbytes:]
-            # put new characters in the character buffer
-            self.charbuffer += newchars
-            # there was no data available
-            if not newdata:
+                data = self.sock.recv(65536)
+            except socket.error, err:
+                if err.errno in (EAGAIN, EINTR):
+                    break
+                raise
+            if not data:
+                closed = True
                 break
-        if chars < 0:
-            # Return everything we've got
-            result = self.charbuffer
-            self.charbuffer = u""
+            self.bytes_read += len(data)
+            messages.extend(self.buffer.feed(data))
+
+        full = False
+        changed = False
+        for message in messages:
+            op = message["op"]
+            if op == "exit":
+                closed = True
+            elif op in ("snapshot", "damage"):
+                self.replica.apply(message)
+                changed = True
+                full = full or op == "snapshot"
+        if changed:
+            self.emit(QtCore.SIGNAL("update"), full)
+
+        if closed:
+            self._done()
+        elif self.read_interval:
+            QtCore.QTimer.singleShot(self.read_interval, self.listen)
         else:
-            # Return the first chars characters
-            result = self.charbuffer[:chars]
-            self.charbuffer = self.charbuffer[chars:]
-        return result
+            self.listen()
+
+    def _done(self):
+        self.notifier.setEnabled(False)
+        self.write_notifier.setEnabled(False)
+        self.sock.close()
+        if not self.done:
+            self.done = True
+            self.emit(QtCore.SIGNAL("done"))
+
+    def listen(self):
+        if not self.done and not self.closing:
+            self.notifier.setEnabled(True)
+
+    def set_read_interval(self, interval):
+        self.read_interval = interval
 
-    def decode(self, data):
+    def send(self, message):
+        self.output += daemon.encode_message(message)
+        self._write_ready()
+
+    def _write_ready(self, fd=None):
+        if self.done:
+            return
         try:
-            chars = data.decode("utf-8")
-            return chars, len(data)
-        except UnicodeDecodeError, exc:
-            return self.decode(data[:exc.start])
+            sent = self.sock.send(self.output)
+        except socket.error, err:
+            if err.errno not in (EAGAIN, EINTR):
+                raise
+            sent = 0
+        self.output = self.output[sent:]
+        if self.closing and not self.output:
+            self._done()
+        else:
+            self.write_notifier.setEnabled(bool(self.output))
 
     def write(self, text):
-        self.stream.write("%s" % str(text))
+        self.send({"op": "input", "data": unicode(text)})
 
-    def run(self):
-        while self.stream.isalive():
-            time.sleep(1)
+    def paste(self, text, bracketed=False):
+        self.send({"op": "paste", "data": unicode(text),
+                   "bracketed": bracketed})
+
+    def resize(self, rows, cols):
+        self.send({"op": "resize", "rows": rows, "cols": cols})
+
+    def close_pty(self):
+        if self.done or self.closing:
+            return
+        # the rest goes out as the daemon takes it, the GUI doesn't wait;
+        # a daemon that takes nothing for a while loses the input queued
+        self.closing = True
+        self.notifier.setEnabled(False)
+        self.send({"op": "detach"})
+        if not self.done:
+            QtCore.QTimer.singleShot(CLOSE_TIMEOUT, self._done)
 
-        self.emit(QtCore.SIGNAL("done"))
+
+class ProcessSession(QtCore.QObject):
+    """
+    A session read and parsed in a child process, see emuprocess. The GUI
+    only copies the published grid into the terminal of the widget and
+    renders it, so parsing and painting run on separate cores.
+    """
+    def __init__(self, parent, cmd_path):
+        super(ProcessSession, self).__init__()
+
+        self._parent = parent
+        self.connect(parent, QtCore.SIGNAL("write"), self.write)
+        self.connect(parent, QtCore.SIGNAL("resize"), self.resize)
+        self.connect(parent, QtCore.SIGNAL("close_pty"), self.close_pty)
+        self.connect(parent, QtCore.SIGNAL("paste"), self.paste)
+
+        self.terminal = parent.terminal
+        rows, cols = self.terminal.GetSize()
+        self.process, self.grid, self.wake_fd = emuprocess.start(cmd_path,
+                                                                 rows, cols)
+        self.buffer = daemon.MessageBuffer()
+        self.output = ""
+        self.read_interval = 0
+        self.done = False
+
+        stdout = self.process.stdout.fileno()
+        stdin = self.process.stdin.fileno()
+        daemon.set_non_blocking(stdout)
+        daemon.set_non_blocking(stdin)
+
+        self.notifier = QtCore.QSocketNotifier(self.wake_fd,
+                                               QtCore.QSocketNotifier.Read)
+        self.connect(self.notifier, QtCore.SIGNAL('activated(int)'),
+                     self.get_frame)
+        self.message_notifier = QtCore.QSocketNotifier(
+            stdout, QtCore.QSocketNotifier.Read)
+        self.connect(self.message_notifier, QtCore.SIGNAL('activated(int)'),
+                     self.get_messages)
+        self.write_notifier = QtCore.QSocketNotifier(
+            stdin, QtCore.QSocketNotifier.Write)
+        self.write_notifier.setEnabled(False)
+        self.connect(self.write_notifier, QtCore.SIGNAL('activated(int)'),
+                     self._write_ready)
+
+    @property
+    def bytes_read(self):
+        return self.grid.bytes_read
+
+    def get_frame(self, fd):
+        self.notifier.setEnabled(False)
+        try:
+            while os.read(self.wake_fd, 4096):
+                pass
+        except OSError, err:
+            if err.errno != EAGAIN:
+                raise
+
+        # any no. of frames published since the last wakeup are read as one
+        changed, full = self.grid.read(self.terminal)
+        if changed:
+            self.emit(QtCore.SIGNAL("update"), full)
+
+        if self.read_interval:
+            QtCore.QTimer.singleShot(self.read_interval, self.listen)
+        else:
+            self.listen()
+
+    def get_messages(self, fd):
+        try:
+            data = os.read(fd, 65536)
+        except OSError, err:
+            if err.errno in (EAGAIN, EINTR):
+                return
+            raise
+        if not data:
+            self._done()
+            return
+        for message in self.buffer.feed(data):
+            if message["op"] == "title":
+                callback = self.terminal.callbacks[
+                    self.terminal.CALLBACK_UPDATE_WINDOW_TITLE]
+                if callback is not None:
+                    callback(message["title"])
+            elif message["op"] == "exit":
+                # the last frame was published before
+                self.get_frame(self.wake_fd)
+                self._done()
+
+    def _done(self):
+        self.notifier.setEnabled(False)
+        self.message_notifier.setEnabled(False)
+        self.write_notifier.setEnabled(False)
+        if not self.done:
+            self.done = True
+            self.process.wait()
+            self.emit(QtCore.SIGNAL("done"))
+
+    def listen(self):
+        if not self.done:
+            self.notifier.setEnabled(True)
+
+    def set_read_interval(self, interval):
+        self.read_interval = interval
+
+    def send(self, message):
+        self.output += daemon.encode_message(message)
+        self._write_ready()
+
+    def _write_ready(self, fd=None):
+        if self.done:
+            return
+        try:
+            written = os.write(self.process.stdin.fileno(), self.output)
+        except OSError, err:
+            if err.errno not in (EAGAIN, EINTR):
+                raise
+            written = 0
+        self.output = self.output[written:]
+        self.write_notifier.setEnabled(bool(self.output))
+
+    def write(self, text):
+        self.send({"op": "input", "data": unicode(text)})
+
+    def paste(self, text, bracketed=False):
+        self.send({"op": "paste", "data": unicode(text),
+                   "bracketed": bracketed})
 
     def resize(self, rows, cols):
-        self.stream.setwinsize(rows, cols)
+        self.send({"op": "resize", "rows": rows, "cols": cols})
 
     def close_pty(self):
-        self.stream.terminate(True)
-  
\ No newline at end of file
+        if self.done:
+            return
+        self.done = True
+        self.notifier.setEnabled(False)
+        self.message_notifier.setEnabled(False)
+        self.write_notifier.setEnabled(False)
+        # closing its stdin makes the child terminate the shell and exit
+        self.process.stdin.close()
+        self.process.wait()
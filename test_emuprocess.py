@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+import mmap
+import unittest
+import emuprocess
+import emuvt100
+
+
+class GridTest(unittest.TestCase):
+    def setUp(self):
+        self.buffer = mmap.mmap(-1, emuprocess.SharedGrid.size())
+        self.writer = emuprocess.GridWriter(self.buffer)
+        self.reader = emuprocess.GridReader(self.buffer)
+        self.source = emuvt100.V102Terminal(5, 20)
+        self.terminal = emuvt100.V102Terminal(5, 20)
+
+    def keys(self, lines):
+        return [[rendition.key() if rendition else None
+                 for rendition in renditions] for renditions in lines]
+
+    def test_repeated_intensity(self):
+        # every rendition key has to fit the shared rendition table
+        self.source.ProcessInput(u"\033[1m" * 130 + u"bold" +
+                                 u"\033[2m" * 300 + u"faint")
+        self.writer.publish(self.source)
+        self.reader.read(self.terminal)
+        self.assertEqual(self.terminal.GetRawScreen(),
+                         self.source.GetRawScreen())
+        self.assertEqual(self.keys(self.terminal.scrRendition),
+                         self.keys(self.source.scrRendition))
+        self.assertEqual(self.terminal.GetRendition(0, 0).intensity, 1)
+        self.assertEqual(self.terminal.GetRendition(0, 4).intensity, -1)
+
+    def test_scrolled_lines(self):
+        # the lines scrolled off between two frames reach the history
+        scrolled = []
+        screen = self.source.GetRawScreen()
+        scrRendition = self.source.GetRawScreenRendition()
+        self.source.SetCallback(
+            self.source.CALLBACK_SCROLL_UP_SCREEN,
+            lambda: scrolled.append((screen[0][:], scrRendition[0][:])))
+        self.source.SetHistorySize(100)
+        self.terminal.SetHistorySize(100)
+        self.source.ProcessInput(u"top\r\n")
+        self.writer.publish(self.source)
+        self.reader.read(self.terminal)
+        self.source.ProcessInput(u"".join(u"\033[1mline %d\033[m\r\n" % i
+                                          for i in xrange(20)))
+        self.writer.publish(self.source, len(scrolled), history=scrolled)
+        self.reader.read(self.terminal)
+        self.assertEqual(self.terminal.GetRawScreen(),
+                         self.source.GetRawScreen())
+        self.assertEqual([line for line, rendition in self.terminal.history],
+                         [line for line, rendition in self.source.history])
+        self.assertEqual(self.keys(renditions for line, renditions
+                                   in self.terminal.history),
+                         self.keys(renditions for line, renditions
+                                   in self.source.history))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,33 +19,27 @@
 # along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
 from PyQt4 import QtGui, QtCore
 import sys
+import time
 import emuvt100
+import hud
+import renderer
+import rowcache
+import scheduler
 import session
 
-# NORMAL, LIGHT/BRIGHT
-COLOR_TABLE = [#black
-               (QtGui.QColor(0, 0, 0), QtGui.QColor(0, 0, 0)),
-               #red
-               (QtGui.QColor(205, 0, 0), QtGui.QColor(205, 0, 0)),
-               #green
-               (QtGui.QColor(0, 205, 0), QtGui.QColor(205, 0, 0)),
-               #brown,yellow
-               (QtGui.QColor(205, 205, 0), QtGui.QColor(205, 0, 0)),
-               #blue
-               (QtGui.QColor(0, 0, 238), QtGui.QColor(205, 0, 0)),
-               #magenta
-               (QtGui.QColor(205, 0, 205), QtGui.QColor(205, 0, 0)),
-               #cyan
-               (QtGui.QColor(0, 205, 205), QtGui.QColor(205, 0, 0)),
-               #gray
-               (QtGui.QColor(229, 229, 229), QtGui.QColor(205, 0, 0))]
+COLOR_TABLE = renderer.COLOR_TABLE
 
 
 class HaikutermWidget(QtGui.QFrame):
-    def __init__(self, parent=None, app=None):
+    def __init__(self, parent=None, app=None, threaded_render=False,
+                 threaded_read=False, session_manager=None):
         super(HaikutermWidget, self).__init__(parent)
         
         self.app = app
+        self.threaded_render = threaded_render
+        self.threaded_read = threaded_read
+        # reads the output of this and other terminals, see SessionManager
+        self.session_manager = session_manager
 
         self.ROWS = self.rows = 24
         self.COLS = self.cols = 80
@@ -57,6 +51,8 @@ class HaikutermWidget(QtGui.QFrame):
         self.background_color = QtGui.QColor(0, 0, 0)
         self.foreground_color = QtGui.QColor(255, 255, 255)
 
+        self.history_size = 100
+
         self.terminal = None
         self.set_terminal()
 
@@ -72,51 +68,135 @@ class HaikutermWidget(QtGui.QFrame):
         self.cell_width = 1
         self.cell_height = 1
 
-        self.screen = {}
-        self.screenRend = {}
+        # emulator generation of every row as last drawn, rows changed in a
+        # later generation are drawn again on the next frame
+        self._drawn_generation = []
 
         self.shell = None
 
-        self.set_default_font()
+        # the widget is a fixed size viewport over the history and the
+        # screen, scroll_offset is how many lines it's scrolled back
+        self.scroll_offset = 0
+        self.scroll_bar = QtGui.QScrollBar(QtCore.Qt.Vertical, self)
+        self.scroll_bar.setRange(0, 0)
+        self.scroll_bar.setCursor(QtCore.Qt.ArrowCursor)
+        self.connect(self.scroll_bar, QtCore.SIGNAL("valueChanged(int)"),
+                     self._scroll_bar_moved)
+        self.setContentsMargins(0, 0, self.scroll_bar.sizeHint().width(), 0)
+
+        # rendered history rows, so browsing back and forth mostly blits
+        self.row_cache = rowcache.RowImageCache()
+
+        # draws frames into the offscreen copy of the whole grid, in the GUI
+        # thread or in a RenderWorker, paintEvent only blits the exposed
+        # rectangle of the result
+        self.rasterizer = None
+        self.render_worker = None
+
+        # lines scrolled by the emulator and not drawn yet
+        self._pending_scroll = 0
+
+        # while hidden the output is parsed but not tracked nor rendered,
+        # and read at most once every background_read_interval milliseconds
+        self.suspended = False
+        self.background_read_interval = 0
+
+        # the grid, the emulator and the pty are resized once the widget
+        # size settles, intermediate sizes are painted from the old grid
+        self.resize_timer = QtCore.QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(100)
+        self.connect(self.resize_timer, QtCore.SIGNAL("timeout()"),
+                     self._apply_resize)
 
-        self._changes = []
+        self.set_default_font()
+        self.scheduler = scheduler.FrameScheduler(self.render_frame, self)
 
         self.redraw_screen = False
 
-        self.cursor_pos = [{"x":0, "y":0, "row":0, "col":0},
-                           {"x":0, "y":0, "row":0, "col":0}]
-        self.cursor_row = 0
-        self.cursor_col = 0
+        # previous and current cursor cell, the cursor is drawn over the
+        # backing store on every paint and never dirties rows
+        self.cursor_pos = [{"row":0, "col":0}, {"row":0, "col":0}]
         self.cursor_color = COLOR_TABLE[7][0]
         self.cursor_type = 0
 
+        # cells drawn with a blinking rendition, redrawn on every blink
+        self._blinking_cells = set()
+
         self.blinking = False
-        self.blink = False
+        self.blink = True
         self.blink_timer = QtCore.QTimer()
-        self.blink_timer.start(1000)
+        self.blink_timer.setInterval(1000)
+        self.connect(self.blink_timer, QtCore.SIGNAL("timeout()"),
+                     self.blink_bang)
         self.update_blinking(activate=True)
 
-        self.history_size = 100
-        self.scroll_area = QtGui.QScrollArea()
-        self.set_scroll()
-
-    def set_scroll(self):
-        self.scroll_area.setVerticalScrollBarPolicy(
-            QtCore.Qt.ScrollBarAlwaysOn)
-        self.scroll_area.setWidget(self)
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area.show()
-
-    def activateWindow(self):
-        self.redraw_screen = True
-        super(HaikutermWidget, self).activateWindow()
+        # performance overlay, refreshed once a second while visible
+        self.hud = hud.PerformanceHud()
+        self.hud_timer = QtCore.QTimer(self)
+        self.hud_timer.setInterval(1000)
+        self.connect(self.hud_timer, QtCore.SIGNAL("timeout()"),
+                     self._update_hud)
+        self.paints = 0
+
+        self.rasterizer = renderer.Rasterizer(self.background_color)
+        if self.threaded_render:
+            self.render_worker = renderer.RenderWorker(self.background_color)
+            self.connect(self.render_worker, QtCore.SIGNAL("rendered"),
+                         self._frame_rendered)
+            self.render_worker.start()
+            # closeEvent isn't sent to a widget deleted or left open at exit,
+            # a QThread still running when destroyed aborts the program
+            stop = self.render_worker.stop
+            self.connect(self, QtCore.SIGNAL("destroyed()"), stop)
+            self.connect(QtCore.QCoreApplication.instance(),
+                         QtCore.SIGNAL("aboutToQuit()"), stop)
+
+        self._resize_backing_store()
+
+    def set_scroll_offset(self, offset):
+        """
+        Scrolls the view back the given no. of history lines, 0 shows the
+        screen.
+        """
+        offset = max(0, min(offset, self.terminal.GetHistoryLength()))
+        if offset != self.scroll_offset:
+            self.scroll_offset = offset
+            self._update_scroll_bar()
+            self.update(self.contentsRect())
+
+    def scroll_view(self, lines):
+        self.set_scroll_offset(self.scroll_offset + lines)
+
+    def _scroll_bar_moved(self, value):
+        self.set_scroll_offset(self.terminal.GetHistoryLength() - value)
+
+    def _update_scroll_bar(self):
+        length = self.terminal.GetHistoryLength()
+        self.scroll_offset = min(self.scroll_offset, length)
+
+        self.scroll_bar.blockSignals(True)
+        self.scroll_bar.setRange(0, length)
+        self.scroll_bar.setPageStep(self.rows)
+        self.scroll_bar.setValue(length - self.scroll_offset)
+        self.scroll_bar.blockSignals(False)
 
     def update_blinking(self, activate=False):
-        if not activate and self.blinking:
-            self.disconnect(self.blink_timer, QtCore.SIGNAL("timeout()"))
-        else:
-            self.connect(self.blink_timer, QtCore.SIGNAL("timeout()"),
-                         self.blink_bang)
+        self.blinking = activate
+        self._update_blink_timer()
+
+    def _update_blink_timer(self):
+        # nothing blinks while hidden or unfocused, and a steady cursor with
+        # no blinking cells doesn't need the timer either
+        run = (self.isVisible() and self.hasFocus() and
+               (self.blinking or bool(self._blinking_cells)))
+        if run:
+            if not self.blink_timer.isActive():
+                self.blink_timer.start()
+        elif self.blink_timer.isActive():
+            self.blink_timer.stop()
+            if not self.blink:
+                self.blink_bang()
 
     def set_cursor_type(self, line=True, block=False):
         if block:
@@ -126,14 +206,38 @@ class HaikutermWidget(QtGui.QFrame):
 
     def blink_bang(self):
         self.blink = not self.blink
-        self.update()
+
+        if self._blinking_cells:
+            segments = [self._segment(row, col, col)
+                        for row, col in list(self._blinking_cells)]
+            self.submit_frame(self._frame(segments=segments))
+        self.update(self._cursor_rect())
+
+    def _cells_rect(self, row, first_col, last_col):
+        """
+        Returns the widget rectangle covering the cells first_col..last_col
+        of the given row.
+        """
+        row += self.scroll_offset
+        return QtCore.QRect(
+            self.contentsRect().left() + first_col * self.cell_width,
+            self.contentsRect().top() + row * self.cell_height,
+            (last_col - first_col + 1) * self.cell_width,
+            self.cell_height)
+
+    def _cursor_rect(self, index=1):
+        """
+        Returns the widget rectangle of the current cursor cell, or the
+        previous one for index 0.
+        """
+        pos = self.cursor_pos[index]
+        return self._cells_rect(pos["row"], pos["col"], pos["col"])
 
     def set_terminal(self):
         self.terminal = emuvt100.V102Terminal(self.rows, self.cols)
+        self.terminal.SetHistorySize(self.history_size)
         self.terminal.SetCallback(self.terminal.CALLBACK_SCROLL_UP_SCREEN,
                                   self.scroll_up)
-        self.terminal.SetCallback(self.terminal.CALLBACK_UPDATE_LINES,
-                                  self.update_lines)
         self.terminal.SetCallback(self.terminal.CALLBACK_UPDATE_CURSOR_POS,
                                   self.update_cursor_position)
         self.terminal.SetCallback(self.terminal.CALLBACK_UPDATE_WINDOW_TITLE,
@@ -142,14 +246,39 @@ class HaikutermWidget(QtGui.QFrame):
                                   self.unhandled_esc_seq)
 
     def scroll_up(self):
-        self.resize(self.width(), self.height() + self.cell_height)
-        self.scroll_area.scrollContentsBy(0, self.cell_height)
+        # The emulator calls us right before dropping its first line. The
+        # backing store is shifted on the next frame, the generations drawn
+        # move with the lines now.
+        if self.scroll_offset:
+            # keep showing the same lines while scrolled back, as far as the
+            # history goes once the line is in it
+            length = self.terminal.GetHistoryLength()
+            if length != self.terminal.GetHistorySize():
+                length += 1
+            self.scroll_offset = min(self.scroll_offset + 1, length)
+        if self.suspended:
+            return
+
+        self._pending_scroll += 1
+        if self._drawn_generation:
+            self._drawn_generation.pop(0)
+            self._drawn_generation.append(-1)
+
+        self._blinking_cells = set((row - 1, col)
+                                   for row, col in self._blinking_cells
+                                   if row > 0)
 
     def update_cursor_position(self):
-        self.cursor_pos[0] = self.cursor_pos[1]
         row, col = self.terminal.GetCursorPos()
-        self.cursor_pos[1]["row"] = row
-        self.cursor_pos[1]["col"] = col
+        current = self.cursor_pos[1]
+        if current["row"] == row and current["col"] == col:
+            return
+
+        self.cursor_pos[0] = current
+        self.cursor_pos[1] = {"row":row, "col":col}
+        # only the cell left and the cell entered are repainted
+        self.update(self._cursor_rect(0))
+        self.update(self._cursor_rect(1))
 
     def set_window_title(self, title):
         self.setWindowTitle(title)
@@ -171,43 +300,21 @@ class HaikutermWidget(QtGui.QFrame):
             current_line = u"".join([char for char in line])
             print current_line
 
-    def _get_rendition_font(self, rendition):
-        font = self.font()
-        if rendition.intensity > 0:
-            font.setBold(True)
-        elif rendition.intensity < 0:
-            font.setWeight(font.Light)
-        if rendition.italic:
-            font.setItalic(True)
-        if rendition.underline:
-            font.setUnderline(True)
-        return font
-
-    def _get_color_from_table(self, color_index):
-        return COLOR_TABLE[color_index][0]
-
     def draw_cursor(self, painter):
-        left = self.contentsRect().left()
-        top = self.contentsRect().top()
-
-        # redraw the pass cursor position
-        row = self.cursor_pos[0]["row"]
-        col  = self.cursor_pos[0]["col"]
-        rendition = self.terminal.GetRendition(row, col)
+        # the previous position doesn't need to be erased, it's restored from
+        # the backing store on every paint
+        if not self.blink:
+            return
 
-        char = self.terminal.GetChar(row, col)
-        self.draw_char(painter, row, col, rendition, char)
+        # scrolled back far enough to hide the screen row of the cursor
+        if self.cursor_pos[1]["row"] + self.scroll_offset >= self.rows:
+            return
 
-        # redraw the current cursor position
-        x = left + self.cursor_pos[1]["col"] * self.cell_width
-        y = top + self.cursor_pos[1]["row"] * self.cell_height
+        rect = self._cursor_rect()
+        x = rect.left()
+        y = rect.top()
 
-        rect = QtCore.QRect(QtCore.QPoint(x, y), QtCore.QSize(self.cell_width,
-                                                             self.cell_height))
-        if self.blink:
-            cursor_color = self.cursor_color
-        else:
-            cursor_color = self.background_color
+        cursor_color = self.cursor_color
 
         if self.cursor_type:
             painter.fillRect(rect, cursor_color)
@@ -216,98 +323,256 @@ class HaikutermWidget(QtGui.QFrame):
             painter.drawLine(QtCore.QPoint(x, y + 2),
                              QtCore.QPoint(x, y + self.cell_height - 1))
 
-    def draw_char(self, painter, row, col, rendition, char):
-        left = self.contentsRect().left()
-        top = self.contentsRect().top()
+    def draw_history(self, painter, rect):
+        """
+        Paints the view while scrolled back. History lines are fetched and
+        drawn only for the visible rows inside rect, the rest of the view
+        shows the top of the screen from the backing store.
+        """
+        origin = self.contentsRect().topLeft()
+        history_length = self.terminal.GetHistoryLength()
+        history_rows = min(self.scroll_offset, history_length, self.rows)
+
+        first_row = max(0, (rect.top() - origin.y()) / self.cell_height)
+        last_row = min(history_rows - 1,
+                       (rect.bottom() - origin.y()) / self.cell_height)
+
+        for row in xrange(first_row, last_row + 1):
+            index = history_length - min(self.scroll_offset,
+                                         history_length) + row
+            line, renditions = self.terminal.GetHistoryLine(index)
+            image = self._get_row_image(line, renditions)
+            y = origin.y() + row * self.cell_height
+            painter.drawImage(QtCore.QPoint(origin.x(), y), image)
+
+        top = origin.y() + history_rows * self.cell_height
+        target = QtCore.QRect(QtCore.QPoint(origin.x(), top),
+                              self.contentsRect().bottomRight())
+        target = target.intersected(rect)
+        if not target.isEmpty():
+            painter.drawImage(target, self.backing_store,
+                              target.translated(-origin.x(), -top))
+
+    def _get_row_image(self, line, renditions):
+        """
+        Returns the image of a history line, rendering and caching it when
+        it isn't in the row cache.
+        """
+        line = line[:self.cols]
+        attrs = tuple(rendition.attr_id if rendition else 0
+                      for rendition in renditions[:self.cols])
+        width = self.contentsRect().width()
+        key = (u"".join(line), attrs, width, self.font().key(),
+               self.cell_width, self.cell_height)
+        if any(rendition and rendition.blinking for rendition in renditions):
+            key += (self.blink,)
+
+        image = self.row_cache.get(key)
+        if image is None:
+            image = QtGui.QImage(width, self.cell_height,
+                                 QtGui.QImage.Format_RGB32)
+            image.fill(self.background_color.rgb())
+            self.rasterizer.configure(self.font(), self.cell_width,
+                                      self.cell_height, self.blink)
+            painter = QtGui.QPainter(image)
+            for col, char in enumerate(line):
+                self.rasterizer.draw_char(painter, 0, col, renditions[col],
+                                          char)
+            painter.end()
+            self.row_cache.put(key, image, image.byteCount())
+        return image
+
+    def set_row_cache_budget(self, budget):
+        """
+        Sets how many bytes of rendered history rows are kept.
+        """
+        self.row_cache.set_budget(budget)
+
+    def set_hud_visible(self, visible):
+        """
+        Shows or hides the performance overlay. While hidden only the
+        counters are kept, nothing is timed.
+        """
+        self.hud.visible = visible
+        for rasterizer in self._rasterizers():
+            rasterizer.timing = visible
+
+        if visible:
+            self.hud.reset(self.performance_counters())
+            self._update_hud()
+            self.hud_timer.start()
+        else:
+            self.hud_timer.stop()
+            self.update(self._hud_rect())
+
+    def performance_counters(self):
+        """
+        Returns the running totals of bytes read, chunks parsed, frames
+        rendered and skipped, paint events and cells drawn.
+        """
+        skipped = self.scheduler.coalesced
+        if self.render_worker is not None:
+            skipped += self.render_worker.dropped
+        return {"bytes": self.shell.bytes_read if self.shell else 0,
+                "chunks": self.terminal.inputChunks,
+                "frames": self.scheduler.frames,
+                "skipped": skipped,
+                "paints": self.paints,
+                "cells": sum(rasterizer.cells_drawn
+                             for rasterizer in self._rasterizers())}
+
+    def _rasterizers(self):
+        rasterizers = [self.rasterizer]
+        if self.render_worker is not None:
+            rasterizers.append(self.render_worker.rasterizer)
+        return rasterizers
+
+    def _hud_rect(self):
+        return self.hud.rect(self.contentsRect(), self.font())
+
+    def _update_hud(self):
+        old_rect = self._hud_rect()
+        render_time = 0.0
+        for rasterizer in self._rasterizers():
+            render_time += rasterizer.render_time
+            rasterizer.render_time = 0.0
+        self.hud.paint_time += render_time
+
+        self.hud.sample(self.performance_counters(),
+                        self.row_cache.hit_rate())
+        self.update(old_rect.united(self._hud_rect()))
+
+    def render_frame(self):
+        """
+        Submits the lines changed since the last frame to the rasterizer.
+        """
+        if self.hud.visible:
+            start = time.time()
+
+        generation = self.terminal.NewGeneration()
+        rows = self.terminal.GetRows()
+
+        full = self.redraw_screen or len(self._drawn_generation) != rows
+        if full:
+            self._drawn_generation = [-1] * rows
+            self._blinking_cells = set()
+        scroll = self._pending_scroll
+        self._pending_scroll = 0
+        if full or scroll:
+            self._update_scroll_bar()
+
+        segments = []
+        for row in xrange(rows):
+            drawn = self._drawn_generation[row]
+            if self.terminal.GetLineGeneration(row) <= drawn:
+                continue
 
-        x = left + col * self.cell_width
-        y = top + row * self.cell_height
+            span = self.terminal.GetLineSpan(row, drawn)
+            if span is not None:
+                segments.append(self._segment(row, span[0], span[1]))
+            self._drawn_generation[row] = generation
+        self.redraw_screen = False
 
-        if rendition:
-            font = self._get_rendition_font(rendition)
-            fg_color = self._get_color_from_table(rendition.fg_color)
-            bg_color = self._get_color_from_table(rendition.bg_color)
-        else:
-            font = self.font()
-            fg_color = self.background_color
-            bg_color = self.background_color
-            
-        rect = QtCore.QRect(QtCore.QPoint(x, y),
-                            QtCore.QSize(self.cell_width,
-                                         self.cell_height))
-        painter.fillRect(rect, bg_color)
-        painter.setFont(font)
-        painter.setPen(fg_color)
-        painter.drawText(rect, QtCore.Qt.AlignCenter, char)
-
-    def draw_screen(self, painter):
-        update_char_count = 0
-        changes = []
-        changes, self._changes = self._changes, changes
-
-        curRendition = emuvt100.Rendition()
-        for row, col, char, rendition in changes:
-            if rendition:
-                curRendition = rendition
-
-            self.draw_char(painter, row, col, curRendition, char)
-
-            update_char_count += 1
-        self.changes_per_update(painter, update_char_count)
-
-    def changes_per_update(self, painter, update_char_count):
-        field_width = 80
-        left = self.contentsRect().right() - field_width
-        top = self.contentsRect().bottom() - self.cell_height - 5
-        update_rect = QtCore.QRect(QtCore.QPoint(left, top),
-                                   QtCore.QSize(field_width, self.cell_height))
-        painter.fillRect(update_rect, self.background_color)
-        painter.setPen(QtCore.Qt.white)
-        painter.drawText(QtCore.QPoint(left, top + self.cell_height),
-                         "Upd: %s" % update_char_count)
-
-    def update_lines(self):
-        for row in self.terminal.GetDirtyLines(self.redraw_screen):
-            line = self.terminal.GetLine(row)
-
-            if row not in self.screen:
-                self.screen[row] = {}
-                self.screenRend[row] = {}
-                for col in xrange(len(line)):
-                    char = self.terminal.GetChar(row, col)
-                    rendition = self.terminal.GetRendition(row, col)
-
-                    self.screen[row].setdefault(col, {1:None})
-                    self.screen[row][col] = char
-
-                    self.screenRend[row].setdefault(col, {1:None})
-                    self.screenRend[row][col] = rendition
-
-                    self._changes.append((row, col, char, rendition))
+        if self.hud.visible:
+            self.hud.diff_time += time.time() - start
+        self.submit_frame(self._frame(full, scroll, segments))
+
+    def _segment(self, row, first_col, last_col):
+        """
+        Returns a frame segment with a copy of the given cells, keeping
+        track of the blinking ones.
+        """
+        end = last_col + 1
+        chars = tuple(self.terminal.GetRawScreen()[row][first_col:end])
+        renditions = tuple(
+            self.terminal.GetRawScreenRendition()[row][first_col:end])
+
+        had_blinking_cells = bool(self._blinking_cells)
+        for col, rendition in enumerate(renditions, first_col):
+            if rendition is not None and rendition.blinking:
+                self._blinking_cells.add((row, col))
             else:
-                for col in xrange(len(line)):
-                    char = self.terminal.GetChar(row, col)
-                    rendition = self.terminal.GetRendition(row, col)
+                self._blinking_cells.discard((row, col))
+        if had_blinking_cells != bool(self._blinking_cells):
+            self._update_blink_timer()
 
-                    if (self.screen[row][col] != char or
-                        rendition is None or
-                        self.screenRend[row][col] != rendition):
+        return row, first_col, chars, renditions
 
-                        self.screen[row][col] = char
-                        self.screenRend[row][col] = rendition
+    def _frame(self, full=False, scroll=0, segments=()):
+        return renderer.Frame(self.contentsRect().size(), self.font(),
+                              self.cell_width, self.cell_height, self.blink,
+                              full, scroll, segments)
 
-                        self._changes.append((row, col, char, rendition))
-        self.update()
+    def submit_frame(self, frame):
+        if self.render_worker is not None:
+            self.render_worker.submit(frame)
+        else:
+            self._frame_rendered(self.rasterizer.rasterize(frame))
+
+    def _frame_rendered(self, rects):
+        if self.scroll_offset:
+            # the screen rows are shifted down by the history shown
+            self.update(self.contentsRect())
+            return
+
+        origin = self.contentsRect().topLeft()
+        region = QtGui.QRegion()
+        for rect in rects:
+            region = region.united(rect.translated(origin))
+        self.update(region)
+
+    def _get_backing_store(self):
+        if self.render_worker is not None:
+            return self.render_worker.image()
+        return self.rasterizer.image
+
+    backing_store = property(_get_backing_store)
+
+    def redraw(self):
+        """
+        Repaints the whole grid into the backing store, or on resume while
+        suspended.
+        """
+        self.redraw_screen = True
+        if not self.suspended:
+            self.render_frame()
+
+    def _resize_backing_store(self):
+        # a full frame gets an image of the new size
+        self.redraw()
 
     def paintEvent(self, event):
+        self.paints += 1
+        if self.hud.visible:
+            start = time.time()
+
         painter = QtGui.QPainter()
         painter.begin(self)
-        if self.redraw_screen:
-            painter.fillRect(self.contentsRect(), self.background_color)
-        self.draw_screen(painter)
+        rect = event.rect()
+        if self.scroll_offset:
+            self.draw_history(painter, rect)
+        else:
+            self.draw_backing_store(painter, rect)
         self.draw_cursor(painter)
+        if self.hud.visible:
+            self.hud.draw(painter, self.contentsRect(), self.font())
         painter.end()
-        self.redraw_screen = False
+
+        if self.hud.visible:
+            self.hud.paint_time += time.time() - start
+
+    def draw_backing_store(self, painter, rect):
+        origin = self.contentsRect().topLeft()
+        image = self.backing_store
+        image_rect = image.rect().translated(origin)
+        if not image_rect.contains(rect):
+            # the widget was resized and the grid hasn't caught up yet
+            exposed = QtGui.QRegion(rect).subtracted(
+                QtGui.QRegion(image_rect))
+            for exposed_rect in exposed.rects():
+                painter.fillRect(exposed_rect, self.background_color)
+            rect = rect.intersected(image_rect)
+        painter.drawImage(rect, image, rect.translated(-origin))
 
     def fontChange(self, font):
         fm = QtGui.QFontMetrics(font) # QFontMetrics fm(font())
@@ -326,8 +591,11 @@ class HaikutermWidget(QtGui.QFrame):
         if self.font_width < 1:
             self.font_width = 1
         self.font_width = fm.averageCharWidth()
+        # images of the old font would never be hit again
+        self.row_cache.clear()
         self._recalculate_grid_size()
-        self.update()
+        if self.rasterizer is not None:
+            self.redraw()
 
     def _recalculate_grid_size(self):
         if not self.fixed_size:
@@ -346,13 +614,45 @@ class HaikutermWidget(QtGui.QFrame):
         if self.terminal:
             term_rows, term_cols = self.terminal.GetSize()
             if term_rows != self.rows or term_cols != self.cols:
+                self._resize_drawn_rows(term_rows, self.rows)
                 self.terminal.Resize(self.rows, self.cols)
                 self.emit(QtCore.SIGNAL("resize"), self.rows, self.cols)
 
-    def resizeEvent(self, e):
+    def _resize_drawn_rows(self, old_rows, rows):
+        # the emulator drops lines from the top when it shrinks, which is
+        # drawn as a scroll, and adds blank ones at the bottom when it grows
+        if rows < old_rows:
+            dropped = old_rows - rows
+            self._pending_scroll += dropped
+            del self._drawn_generation[:dropped]
+            self._blinking_cells = set((row - dropped, col)
+                                       for row, col in self._blinking_cells
+                                       if row >= dropped)
+        else:
+            self._drawn_generation.extend([-1] * (rows - old_rows))
+
+    def _apply_resize(self):
+        """
+        Fits the grid to the widget, resizing the emulator and the pty if
+        the no. of rows or cols changed. Only new cells are drawn unless
+        the cells changed size.
+        """
+        self.resize_timer.stop()
+        cell_size = (self.cell_width, self.cell_height)
         self._recalculate_grid_size()
-        self.redraw_screen = True
-        self.screen = {}
+        if (self.cell_width, self.cell_height) != cell_size:
+            self.redraw()
+        elif not self.suspended:
+            self.render_frame()
+
+    def resizeEvent(self, e):
+        width = self.scroll_bar.sizeHint().width()
+        self.scroll_bar.setGeometry(self.width() - width, 0,
+                                    width, self.height())
+        if self.isVisible():
+            self.resize_timer.start()
+        else:
+            self._apply_resize()
         super(HaikutermWidget, self).resizeEvent(e)
 
     def get_fixed_size(self):
@@ -360,25 +660,117 @@ class HaikutermWidget(QtGui.QFrame):
 
     def set_fixed_size(self, value):
         self._fixed_size = value
-        self._recalculate_grid_size()
+        self._apply_resize()
 
     fixed_size = property(get_fixed_size, set_fixed_size)
 
     def run_shell(self, path):
-        self.shell = session.Session(self, path)
+        self.shell = session.Session(self, path,
+                                     threaded=self.threaded_read,
+                                     manager=self.session_manager)
         self.connect(self.shell, QtCore.SIGNAL("receive"), self.read_output)
         self.connect(self.shell, QtCore.SIGNAL("done"), self.done)
-        self.shell.start()
         self.emit(QtCore.SIGNAL("resize"), self.rows, self.cols)
 
-    def read_output(self, output):
-        self.terminal.ProcessInput(output)
+    def attach_session(self, socket_path, name="default",
+                       cmd_path="/bin/bash"):
+        """
+        Shows a session run by a daemon.SessionDaemon listening on
+        socket_path, started with cmd_path if there's none by that name.
+        """
+        self.shell = session.RemoteSession(self, socket_path, name, cmd_path)
+        self.connect(self.shell, QtCore.SIGNAL("update"), self.update_output)
+        self.connect(self.shell, QtCore.SIGNAL("done"), self.done)
+
+    def run_process(self, path):
+        """
+        Runs path with the pty read and parsed in a child process, see
+        emuprocess.
+        """
+        self.shell = session.ProcessSession(self, path)
+        self.connect(self.shell, QtCore.SIGNAL("update"), self.update_output)
+        self.connect(self.shell, QtCore.SIGNAL("done"), self.done)
 
-        self.update()
+    def update_output(self, full):
+        """
+        Renders what a RemoteSession or a ProcessSession applied to the
+        terminal.
+        """
+        if full:
+            self.redraw()
+        elif not self.suspended:
+            self.scheduler.schedule()
+
+    def read_output(self, output):
+        if self.hud.visible:
+            start = time.time()
+            self.terminal.ProcessInput(output)
+            self.hud.parse_time += time.time() - start
+        else:
+            self.terminal.ProcessInput(output)
+        if not self.suspended:
+            self.scheduler.schedule()
+
+    def suspend(self):
+        """
+        Stops tracking and rendering changes, output keeps being parsed.
+        """
+        if self.suspended:
+            return
+        self.suspended = True
+        self.scheduler.cancel()
+        self.terminal.SetDamageTracking(False)
+        if self.shell:
+            self.shell.set_read_interval(self.background_read_interval)
+
+    def resume(self):
+        """
+        Renders the whole screen once and goes back to incremental frames.
+        """
+        if not self.suspended:
+            return
+        self.suspended = False
+        self.terminal.SetDamageTracking(True)
+        if self.shell:
+            self.shell.set_read_interval(0)
+        self._pending_scroll = 0
+        self.redraw()
+
+    def set_background_read_interval(self, interval):
+        """
+        Sets how many milliseconds to wait between reads of the child
+        output while hidden, 0 doesn't throttle it.
+        """
+        self.background_read_interval = interval
+        if self.suspended and self.shell:
+            self.shell.set_read_interval(interval)
 
     def keyPressEvent(self, event):
         char_ordinal = event.key()
 
+        if event.modifiers() & QtCore.Qt.ShiftModifier:
+            if char_ordinal == QtCore.Qt.Key_PageUp:
+                self.scroll_view(self.rows)
+                return
+            elif char_ordinal == QtCore.Qt.Key_PageDown:
+                self.scroll_view(-self.rows)
+                return
+            elif (char_ordinal == QtCore.Qt.Key_H and
+                  event.modifiers() & QtCore.Qt.ControlModifier):
+                self.set_hud_visible(not self.hud.visible)
+                return
+
+        # typing brings the screen back into view
+        self.set_scroll_offset(0)
+
+        if ((char_ordinal == QtCore.Qt.Key_Insert and
+             event.modifiers() == QtCore.Qt.ShiftModifier) or
+            (char_ordinal == QtCore.Qt.Key_V and
+             event.modifiers() == (QtCore.Qt.ControlModifier |
+                                   QtCore.Qt.ShiftModifier))):
+            self.paste()
+            return
+
         keystrokes = None
 
         if char_ordinal == QtCore.Qt.Key_Enter:
@@ -403,14 +795,47 @@ class HaikutermWidget(QtGui.QFrame):
         else:
             self.emit(QtCore.SIGNAL("write"), event.text())
 
+    def paste(self):
+        """
+        Sends the clipboard text to the shell, bracketed if the application
+        asked for it.
+        """
+        text = QtGui.QApplication.clipboard().text()
+        if text:
+            self.emit(QtCore.SIGNAL("paste"), text,
+                      self.terminal.IsBracketedPaste())
+
+    def wheelEvent(self, event):
+        self.scroll_view(event.delta() / 40)
+
+    def focusInEvent(self, event):
+        super(HaikutermWidget, self).focusInEvent(event)
+        self._update_blink_timer()
+
+    def focusOutEvent(self, event):
+        super(HaikutermWidget, self).focusOutEvent(event)
+        self._update_blink_timer()
+
+    def showEvent(self, event):
+        super(HaikutermWidget, self).showEvent(event)
+        self.resume()
+        self._update_blink_timer()
+
+    def hideEvent(self, event):
+        super(HaikutermWidget, self).hideEvent(event)
+        self.suspend()
+        self._update_blink_timer()
+
     def closeEvent(self, event):
         if self.shell:
             self.emit(QtCore.SIGNAL("close_pty"))
+        if self.render_worker is not None:
+            self.render_worker.stop()
+            self.render_worker = None
         super(HaikutermWidget, self).closeEvent(event)
 
     def done(self):
-        self.scroll_area.close()
-        #self.close()
+        self.close()
 
 
 def profile():
@@ -428,7 +853,14 @@ def main():
     my_app = QtGui.QApplication(sys.argv)
 
     w = HaikutermWidget(app=my_app)
-    w.run_shell("/bin/bash")
+    if "--attach" in sys.argv:
+        w.attach_session(sys.argv[sys.argv.index("--attach") + 1])
+    elif "--process" in sys.argv:
+        w.run_process("/bin/bash")
+    else:
+        w.run_shell("/bin/bash")
+    if "--hud" in sys.argv:
+        w.set_hud_visible(True)
 
     w.show()
     my_app.exec_()
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# haikuterm is Copyright (c) 2011 Facundo de Guzmán <facudeguzman@gmail.com>
+#
+# This file is part of haikuterm.
+#
+# haikuterm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Foobar is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with haikuterm.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+from errno import EAGAIN
+import os
+
+BRACKETED_PASTE_START = "\033[200~"
+BRACKETED_PASTE_END = "\033[201~"
+
+
+class WriteQueue(object):
+    """
+    Input waiting to be written to a non blocking pty. Writing never
+    blocks: what the pty doesn't take is kept, and the owner calls flush()
+    again once the fd is writable for as long as wants_write() is true.
+
+    Keystrokes typed while earlier input is still waiting are coalesced
+    into a single write. Pastes are split into chunk_size pieces and flush
+    writes at most max_flush bytes, so a big paste doesn't keep the owner
+    from reading the output the child echoes meanwhile.
+    """
+    def __init__(self, fd, encoding="utf-8", chunk_size=4096,
+                 max_flush=16384):
+        self.fd = fd
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.max_flush = max_flush
+
+        # [data, is_paste] items, oldest first
+        self.chunks = collections.deque()
+        self.size = 0
+
+        self.bytes_written = 0
+        self.writes = 0
+
+    def put(self, text):
+        """
+        Queues typed text and writes it right away if nothing is waiting.
+        """
+        data = self._encode(text)
+        if not data:
+            return
+
+        if self.chunks and not self.chunks[-1][1]:
+            self.chunks[-1][0] += data
+        else:
+            self.chunks.append([data, False])
+        self.size += len(data)
+
+        if len(self.chunks) == 1:
+            self.flush()
+
+    def paste(self, text, bracketed=False):
+        """
+        Queues pasted text, between the bracketed paste markers if asked.
+        Markers in the text itself are dropped, or the child would take
+        what follows an end marker as typed.
+        """
+        data = self._encode(text)
+        if bracketed:
+            # removing one marker can join the bytes around it into another
+            stripped = None
+            while stripped != data:
+                stripped = data
+                data = data.replace(BRACKETED_PASTE_START, "").replace(
+                    BRACKETED_PASTE_END, "")
+            data = BRACKETED_PASTE_START + data + BRACKETED_PASTE_END
+        for start in xrange(0, len(data), self.chunk_size):
+            self.chunks.append([data[start:start + self.chunk_size], True])
+        self.size += len(data)
+
+        if self.size == len(data):
+            self.flush()
+
+    def flush(self):
+        """
+        Writes what the pty takes, up to max_flush bytes. Returns False if
+        the child side of the pty is gone, dropping everything queued.
+        """
+        written = 0
+        while self.chunks and written < self.max_flush:
+            chunk = self.chunks[0]
+            try:
+                count = os.write(self.fd, chunk[0])
+            except OSError, err:
+                if err.errno == EAGAIN:
+                    break
+                # EIO, nobody will read it
+                self.clear()
+                return False
+
+            self.writes += 1
+            written += count
+            if count < len(chunk[0]):
+                chunk[0] = chunk[0][count:]
+                break
+            self.chunks.popleft()
+
+        self.size -= written
+        self.bytes_written += written
+        return True
+
+    def wants_write(self):
+        return bool(self.chunks)
+
+    def clear(self):
+        self.chunks.clear()
+        self.size = 0
+
+    def _encode(self, text):
+        if isinstance(text, str):
+            return text
+        # unicode or QString
+        return unicode(text).encode(self.encoding, "replace")